@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+'''
+Renders scatter-plot matrices without the interactive window, e.g. to make figures for many datasets on a compute
+node. Each dataset (or, with --combine, all of them together) becomes one still image, or a numbered sequence of
+animation frames with --frames. For example:
+
+    python batchRender.py data/*.soft.gz --genes A B C -o figures
+    python batchRender.py runs/ experiment.soft --combine --frames 120 --genes A B C -o movie
+
+Directories are loaded as ensembles of .tsd runs. No display is needed where Qt has its offscreen platform
+(QT_QPA_PLATFORM defaults to offscreen here); Qt 4 builds that always want an X server can be run under xvfb-run.
+'''
+import sys, os, argparse, multiprocessing
+import numpy
+
+os.environ.setdefault('QT_QPA_PLATFORM','offscreen')
+
+from PySide.QtGui import QApplication, QImage, QPainter, QColor
+from PySide.QtCore import Qt, QRectF
+from expressionFiles import loadSource, TsdEnsemble
+from expressionTopology import parametricPulseGraph, multiViewPanel, mergeVectorsBatch, mergeBounds
+
+APP = None  # every worker process makes its own QApplication
+
+def openSource(path):
+    if os.path.isdir(path):
+        return TsdEnsemble(path)
+    return loadSource(path)
+
+def datasetName(path):
+    name = os.path.basename(os.path.normpath(path))
+    if name.lower().endswith('.gz'):
+        name = name[:-3]
+    return os.path.splitext(name)[0]
+
+class sourceSet:
+    '''
+    Stands in for Viz as the controller of a multiViewPanel
+    '''
+    def __init__(self, sources):
+        self.sources = sources
+    
+    def getVectorsBatch(self, genes, pairs=None):
+        return mergeVectorsBatch(self.sources,genes,pairs)
+    
+    def getBounds(self, genes):
+        return mergeBounds(self.sources,genes)
+
+def renderJob(job):
+    '''
+    Runs renderFrames in a worker process; a dataset that fails is reported and counts as no images, so the rest
+    of the batch still gets rendered
+    '''
+    try:
+        return renderFrames(*job)
+    except Exception, e:
+        print "%s: %s" % (', '.join(job[0]),e)
+        return 0
+
+def renderFrames(paths, genes, target, frames, scale):
+    '''
+    Loads a job's data, lays out the matrix for its genes and writes one image per (position, output path) frame,
+    where position is how far through the time range (0 to 1) the frame is
+    '''
+    global APP
+    if APP == None:
+        APP = QApplication.instance()
+        if APP == None:
+            APP = QApplication(sys.argv[:1])
+    
+    sources = []
+    for p in paths:
+        s = openSource(p)
+        if s == None:
+            continue
+        if None in s.timeRange():
+            print "%s: no timepoints, skipping" % p
+            continue
+        sources.append(s)
+    if len(sources) == 0:
+        print "%s: nothing to render" % ', '.join(paths)
+        return 0
+    parametricPulseGraph.updateTimes(min(s.timeRange()[0] for s in sources),max(s.timeRange()[1] for s in sources))
+    classes = sorted(set(c for s in sources for c in s.classList()))
+    parametricPulseGraph.COLOR_MAP = dict((c,QColor.fromHsv(360*i/len(classes),200,255)) for i,c in enumerate(classes))
+    parametricPulseGraph.COLOR_VERSION += 1
+    
+    known = set()
+    for s in sources:
+        known.update(s.geneList())
+    for g in genes:
+        if not g in known:
+            print "%s: no data for %s" % (', '.join(paths),g)
+    
+    genes = [g for g in genes if g in known]
+    if len(genes) == 0:
+        return 0
+    panel = multiViewPanel(None,sourceSet(sources))
+    for g in genes:
+        panel.addVariable(g)
+    if target != None and target[0] in panel.variables and target[1] in panel.variables:
+        panel.setTarget(*target)
+    
+    sceneRect = panel.scene.sceneRect()
+    image = QImage(int(sceneRect.width()*scale),int(sceneRect.height()*scale),QImage.Format_ARGB32_Premultiplied)
+    for position,output in frames:
+        parametricPulseGraph.CURRENT_TIME = parametricPulseGraph.TIME_START + position*(parametricPulseGraph.TIME_END-parametricPulseGraph.TIME_START)
+        image.fill(QColor(Qt.white).rgba())
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        panel.scene.render(painter,QRectF(image.rect()),sceneRect)
+        painter.end()
+        image.save(output)
+    return len(frames)
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description='Render scatter-plot matrices of gene expression data offscreen')
+    parser.add_argument('paths', nargs='+', help='.soft, .soft.gz or .tsd files, or directories of .tsd runs')
+    parser.add_argument('--genes', nargs='+', required=True, help='genes to put in the matrix, in order')
+    parser.add_argument('-o', '--output', default='.', help='directory to write images to (default: current directory)')
+    parser.add_argument('--frames', type=int, help='write this many animation frames across the time range instead of a still image')
+    parser.add_argument('--position', type=float, default=0.5, help='for a still image, how far through the time range to show the slice, from 0 to 1 (default: 0.5)')
+    parser.add_argument('--target', nargs=2, metavar=('X','Y'), help='show the plot of gene X against gene Y enlarged')
+    parser.add_argument('--combine', action='store_true', help='draw all the data in one matrix instead of one per path')
+    parser.add_argument('--scale', type=float, default=1.0, help='image size relative to the on-screen size (default: 1)')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='worker processes (default: one per CPU)')
+    args = parser.parse_args()
+    
+    if args.combine:
+        datasets = [('matrix',args.paths)]
+    else:
+        datasets = [(datasetName(p),[p]) for p in args.paths]
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    
+    # One job per dataset, with each dataset's frames split up further if there are processes to spare
+    jobs = []
+    for name,paths in datasets:
+        if args.frames == None:
+            frames = [(args.position,os.path.join(args.output,'%s.png' % name))]
+        else:
+            frames = [(i/max(1.0,args.frames-1.0),os.path.join(args.output,'%s_%05i.png' % (name,i))) for i in xrange(args.frames)]
+        chunks = max(1,min(len(frames),args.processes // len(datasets)))
+        if chunks > 1:
+            # Load once here first so the workers don't race to write the same cache files
+            for p in paths:
+                try:
+                    openSource(p)
+                except Exception:
+                    pass    # the job reports it
+        for chunk in numpy.array_split(numpy.arange(len(frames)),chunks):
+            jobs.append((paths,args.genes,args.target,[frames[i] for i in chunk],args.scale))
+    
+    if args.processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(args.processes,len(jobs)))
+        written = list(pool.imap_unordered(renderJob,jobs))
+        pool.close()
+        pool.join()
+    else:
+        written = [renderJob(job) for job in jobs]
+    print "Wrote %i image%s to %s" % (sum(written),'' if sum(written) == 1 else 's',args.output)
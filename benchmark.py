@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+'''
+Rough benchmarks for comparing performance before and after changes. Usage:
+
+    python benchmark.py tsd [rows] [species]
+    python benchmark.py render [matrix size] [segments per class] [frames]
+'''
+import sys, os, time, tempfile
+import numpy
+from expressionFiles import TsdFile
+
+def bestOf(repeats, function, *args):
+    best = None
+    for i in xrange(repeats):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+def writeSyntheticTsd(path, numRows, numSpecies):
+    values = numpy.random.poisson(50,(numRows,numSpecies))
+    with open(path,'wb') as outfile:
+        outfile.write('(("time",%s)' % ','.join('"S%i"' % i for i in xrange(numSpecies)))
+        for t,row in enumerate(values):
+            outfile.write(',(%i,%s)' % (t,','.join(str(v) for v in row)))
+        outfile.write(')')
+
+def legacyTsdRead(path):
+    '''
+    The string replace/split and per-cell float() parser that TsdFile used to use
+    '''
+    minTime = None
+    maxTime = None
+    with open(path,'rb') as infile:
+        allData = infile.read().strip()
+        allData = allData[1:-1].replace(')','')
+        rows = allData.split(',(')
+        genes = rows[0][1:].replace('"','')
+        genes = genes.strip().split(',')
+        genes[0] = 'time'
+        rows = rows[1:]
+        for i,r in enumerate(rows):
+            rows[i] = r.split(',')
+            for j,c in enumerate(rows[i]):
+                rows[i][j] = float(c.strip())
+                if j == 0:
+                    if minTime == None:
+                        minTime = rows[i][j]
+                        maxTime = rows[i][j]
+                    else:
+                        minTime = min(minTime,rows[i][j])
+                        maxTime = max(maxTime,rows[i][j])
+    return (genes,rows)
+
+def benchmarkTsd(numRows=100000, numSpecies=20):
+    handle,path = tempfile.mkstemp(suffix='.tsd')
+    os.close(handle)
+    try:
+        writeSyntheticTsd(path,numRows,numSpecies)
+        print "Synthetic TSD file: %i rows x %i species, %.1f MB" % (numRows,numSpecies,os.path.getsize(path)/2.0**20)
+        legacy = bestOf(3,legacyTsdRead,path)
+        current = bestOf(3,TsdFile,path,False)
+        print "legacy parser:  %.3f s" % legacy
+        print "TsdFile:        %.3f s" % current
+        print "speed-up:       %.1fx" % (legacy/current)
+    finally:
+        os.remove(path)
+
+def legacyPaint(tile, painter):
+    '''
+    How parametricPulseGraph used to draw its data: a new QPen, setOpacity, setPen and drawLine for every segment,
+    and again for its part of the time slice
+    '''
+    from PySide.QtGui import QPen
+    from PySide.QtCore import QRectF
+    from expressionTopology import parametricPulseGraph
+    painter.setPen(parametricPulseGraph.BORDER)
+    painter.setOpacity(parametricPulseGraph.BACKGROUND_OPACITY)
+    painter.drawRect(QRectF(0,0,tile.width,tile.height))
+    painter.fillRect(QRectF(0,0,tile.width,tile.height),parametricPulseGraph.BACKGROUND)
+    xScale = tile.width / (tile.xmax-tile.xmin)
+    yScale = tile.height / (tile.ymax-tile.ymin)
+    for cat,color in parametricPulseGraph.COLOR_MAP.iteritems():
+        for x0,y0,t0,x1,y1,t1 in tile.vectors[cat]:
+            x0 = (x0-tile.xmin)*xScale
+            x1 = (x1-tile.xmin)*xScale
+            y0 = (y0-tile.ymin)*yScale
+            y1 = (y1-tile.ymin)*yScale
+            painter.setOpacity(parametricPulseGraph.UNSLICED_OPACITY)
+            painter.setPen(QPen(color,parametricPulseGraph.UNSLICED_THICKNESS))
+            painter.drawLine(x0,y0,x1,y1)
+            startTime = max(parametricPulseGraph.CURRENT_TIME-parametricPulseGraph.SLICE_DURATION,t0)
+            endTime = min(parametricPulseGraph.CURRENT_TIME+parametricPulseGraph.SLICE_DURATION,t1)
+            if not endTime <= startTime:
+                startTime = (startTime-t0)/(t1-t0)
+                endTime = (endTime-t0)/(t1-t0)
+                painter.setOpacity(parametricPulseGraph.SLICED_OPACITY)
+                painter.setPen(QPen(color,parametricPulseGraph.SLICED_THICKNESS))
+                painter.drawLine(x0+(x1-x0)*startTime,y0+(y1-y0)*startTime,x0+(x1-x0)*endTime,y0+(y1-y0)*endTime)
+
+def currentPaint(tile, painter):
+    tile.paint(painter,None)
+
+def benchmarkRender(matrixSize=20, numSegments=1000, numFrames=10):
+    from PySide.QtGui import QApplication, QImage, QPainter, QColor
+    from expressionTopology import parametricPulseGraph
+    app = QApplication.instance()
+    if app == None:
+        app = QApplication(sys.argv[:1])
+    
+    # Every tile gets a random walk per class
+    classes = ['class %i' % i for i in xrange(3)]
+    parametricPulseGraph.COLOR_MAP = dict((c,QColor.fromHsv(120*i,255,255)) for i,c in enumerate(classes))
+    parametricPulseGraph.updateTimes(0,numSegments)
+    times = numpy.arange(numSegments+1,dtype=numpy.float64)
+    tiles = []
+    for i in xrange(matrixSize**2):
+        vectors = {}
+        for c in classes:
+            walk = numpy.cumsum(numpy.random.randn(numSegments+1,2),axis=0)
+            vectors[c] = numpy.column_stack((walk[:-1,0],walk[:-1,1],times[:-1],walk[1:,0],walk[1:,1],times[1:]))
+        tile = parametricPulseGraph(None,'x','y',vectors)
+        tile.width = parametricPulseGraph.SMALL_SIZE
+        tile.height = parametricPulseGraph.SMALL_SIZE
+        tiles.append(tile)
+    image = QImage(parametricPulseGraph.SMALL_SIZE*matrixSize,parametricPulseGraph.SMALL_SIZE*matrixSize,QImage.Format_ARGB32_Premultiplied)
+    
+    def drawFrame(paintFunction):
+        painter = QPainter(image)
+        for i,tile in enumerate(tiles):
+            painter.save()
+            painter.translate((i % matrixSize)*tile.width,(i // matrixSize)*tile.height)
+            paintFunction(tile,painter)
+            painter.restore()
+        painter.end()
+        parametricPulseGraph.nextFrame()
+    
+    print "%ix%i matrix, %i classes x %i segments per tile, %i frames" % (matrixSize,matrixSize,len(classes),numSegments,numFrames)
+    for name,paintFunction in [('legacy per-segment drawing',legacyPaint),('parametricPulseGraph.paint',currentPaint)]:
+        start = time.time()
+        drawFrame(paintFunction)
+        first = time.time() - start
+        start = time.time()
+        for f in xrange(numFrames):
+            drawFrame(paintFunction)
+        print "%s: first frame %.1f ms, then %.1f ms per frame" % (name,1000*first,1000*(time.time()-start)/numFrames)
+
+if __name__ == '__main__':
+    benchmarks = {'tsd':benchmarkTsd,'render':benchmarkRender}
+    if len(sys.argv) < 2 or not benchmarks.has_key(sys.argv[1]):
+        print __doc__
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*[int(a) for a in sys.argv[2:]])
@@ -1,4 +1,317 @@
-import re, os
+import re, os, gzip, operator, hashlib, json, string, warnings, tempfile
+import numpy
+
+BATCH_ELEMENTS = 2**22  # upper bound on pairs x timepoints materialized at once by batchVectors
+READ_BLOCK_SIZE = 2**22 # bytes read (before decompression) per block by readBlocks
+MERGE_ROWS = 2**16      # table rows merged at once when several probes share an identifier
+MISSING_VALUES = ['','null','NULL','Null','NA','N/A','na','n/a','-']
+TSD_SEPARATORS = string.maketrans('(),','   ')
+TABLE_SEPARATORS = string.maketrans('\t\n','  ')
+CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'),'.expressionTopology','cache')
+CACHE_VERSION = 4
+
+def openFile(path):
+    '''
+    Opens plain or gzipped (.gz) files for reading
+    '''
+    if path.lower().endswith('.gz'):
+        return gzip.open(path,'rb')
+    return open(path,'rb')
+
+def readBlocks(infile, blockSize=READ_BLOCK_SIZE):
+    '''
+    Yields (lines, position) for large blocks of infile, where lines are the complete lines in the block (without
+    line endings) and position is how far we are into the file on disk (i.e. before decompression)
+    '''
+    raw = getattr(infile,'fileobj',infile)  # GzipFile keeps the compressed file in fileobj
+    remainder = ''
+    while True:
+        data = infile.read(blockSize)
+        if len(data) == 0:
+            break
+        lines = (remainder + data).split('\n')
+        remainder = lines.pop()
+        yield lines,raw.tell()
+    if len(remainder) > 0:
+        yield [remainder],raw.tell()
+
+def cachePaths(path):
+    '''
+    The header (.json) and raw matrix (.bin) files that cache the parsed contents of path
+    '''
+    path = os.path.abspath(path)
+    if isinstance(path,unicode):
+        path = path.encode('utf-8')
+    key = hashlib.sha1(path).hexdigest()
+    return (os.path.join(CACHE_DIRECTORY,key + '.json'),os.path.join(CACHE_DIRECTORY,key + '.bin'))
+
+def openMatrix(path, dtype, shape, mode='r'):
+    '''
+    Memory-maps a raw matrix file (empty matrices can't be mapped, so they are simply allocated)
+    '''
+    shape = tuple(shape)
+    if numpy.prod(shape) == 0:
+        return numpy.empty(shape,dtype=dtype)
+    return numpy.memmap(path,dtype=dtype,mode=mode,shape=shape)
+
+def readCache(path, kind):
+    '''
+    Returns the (header, matrix) that writeCache stored for path, or None if nothing is cached or path has changed
+    since (by size or modification time). The matrix is memory-mapped, not read into RAM.
+    '''
+    headerPath,matrixPath = cachePaths(path)
+    try:
+        stat = os.stat(path)
+        with open(headerPath,'rb') as infile:
+            header = json.load(infile)
+        if header.get('version') != CACHE_VERSION or header.get('kind') != kind or \
+           header.get('path') != os.path.abspath(path) or header.get('size') != stat.st_size or header.get('mtime') != stat.st_mtime:
+            return None
+        # The header could belong to an older matrix that has just been replaced
+        if os.path.getsize(matrixPath) != numpy.dtype(header['dtype']).itemsize*int(numpy.prod(header['shape'])):
+            return None
+        matrix = openMatrix(matrixPath,header['dtype'],header['shape'])
+    except (IOError,OSError,ValueError):
+        return None
+    return (header,matrix)
+
+def invalidateCache(path):
+    '''
+    Removes the cached header for path, so that its matrix file can be rewritten, and returns the matrix file's path
+    '''
+    headerPath,matrixPath = cachePaths(path)
+    if not os.path.isdir(CACHE_DIRECTORY):
+        os.makedirs(CACHE_DIRECTORY)
+    if os.path.exists(headerPath):
+        os.remove(headerPath)
+    return matrixPath
+
+def newCacheFile():
+    '''
+    A new, empty file in the cache directory to write a matrix to, before it is renamed over the cached one; anything
+    that still has the old matrix memory-mapped keeps it, where rewriting the file in place would pull it out from
+    under them
+    '''
+    handle,tempPath = tempfile.mkstemp(suffix='.tmp',dir=CACHE_DIRECTORY)
+    os.close(handle)
+    return tempPath
+
+def writeCacheHeader(path, kind, header, matrix):
+    '''
+    Marks the matrix file for path as valid; this is always the last step of writing a cache, so a half-written cache
+    is never mistaken for a valid one
+    '''
+    headerPath = cachePaths(path)[0]
+    stat = os.stat(path)
+    header = dict(header)
+    header.update({'version':CACHE_VERSION,'kind':kind,'path':os.path.abspath(path),'size':stat.st_size,'mtime':stat.st_mtime,
+                   'dtype':matrix.dtype.str,'shape':list(matrix.shape)})
+    with open(headerPath + '.tmp','wb') as outfile:
+        json.dump(header,outfile)
+    os.rename(headerPath + '.tmp',headerPath)
+
+def writeCache(path, kind, header, matrix):
+    '''
+    Stores the parsed contents of path for readCache; failing to write the cache is not an error
+    '''
+    tempPath = None
+    try:
+        matrixPath = invalidateCache(path)
+        tempPath = newCacheFile()
+        numpy.ascontiguousarray(matrix).tofile(tempPath)
+        os.rename(tempPath,matrixPath)
+        writeCacheHeader(path,kind,header,matrix)
+    except (IOError,OSError,ValueError):   # ValueError: names that aren't valid UTF-8 can't go in the header
+        if tempPath != None and os.path.exists(tempPath):
+            os.remove(tempPath)
+
+def packMatrix(matrix):
+    '''
+    Memory-mapped matrices are pickled as a reference to their file instead of a copy of their contents
+    '''
+    if isinstance(matrix,numpy.memmap) and matrix.filename != None:
+        return ('memmap',matrix.filename,matrix.dtype.str,matrix.shape)
+    return matrix
+
+def unpackMatrix(packed):
+    if isinstance(packed,tuple):
+        return openMatrix(packed[1],packed[2],packed[3])
+    return packed
+
+def loadSource(path, lazySize=None, progress=None):
+    '''
+    Opens path with the class for its extension, or returns None if the extension isn't supported. SOFT files of at
+    least lazySize bytes are opened in lazy mode, and report how far along they are to progress. Sources pickle
+    compactly, so this can run in a worker process.
+    '''
+    ext = path.lower()
+    if ext.endswith('.gz'):
+        ext = ext[:-3]
+    ext = os.path.splitext(ext)[1]
+    if ext == '.soft':
+        return SoftFile(path,progress=progress,lazy=lazySize != None and os.path.getsize(path) >= lazySize)
+    elif ext == '.tsd':
+        return TsdFile(path)
+    #elif ext == '.csv':
+    #    return CsvFile(path)
+    #elif ext == '.dat':
+    #    return DatFile(path)
+    return None
+
+def readTsd(path):
+    '''
+    Reads an iBioSim .tsd file, which looks like (("time","A","B"),(0,1,2),(1,2,3)). Returns the column names (the
+    first is always 'time') and a rows x columns float64 array, ordered by time.
+    '''
+    with openFile(path) as infile:
+        allData = infile.read()
+    infile.close()
+    headerEnd = allData.find(')')
+    if headerEnd == -1:
+        raise ValueError('No header found in %s' % path)
+    genes = [g.strip().strip('"') for g in allData[:headerEnd].strip().lstrip('(').split(',')]
+    genes[0] = 'time'
+    allData = allData[headerEnd+1:]
+    numRows = allData.count('(')
+    # Every parenthesis and comma is just a separator, so numpy can tokenize everything in one pass
+    rows = numpy.fromstring(allData.translate(TSD_SEPARATORS),dtype=numpy.float64,sep=' ')
+    del allData
+    if len(rows) != numRows*len(genes):
+        raise ValueError('Expected %i rows of %i values in %s, but found %i values' % (numRows,len(genes),path,len(rows)))
+    rows = rows.reshape(numRows,len(genes))
+    if numRows > 1 and numpy.any(rows[1:,0] < rows[:-1,0]):
+        rows = rows[numpy.argsort(rows[:,0],kind='mergesort')]
+    return (genes,rows)
+
+def resample(times, values, grid):
+    '''
+    Linearly interpolates values, whose last axis follows the sorted times, onto grid; every other row or column is
+    interpolated at once. Grid points outside the range of times come out as NaN (as do ones next to NaN values).
+    '''
+    defined = numpy.isfinite(times)
+    if not numpy.all(defined):
+        times = times[defined]
+        values = values[...,defined]
+    result = numpy.empty(values.shape[:-1] + (len(grid),),dtype=numpy.float64)
+    result.fill(numpy.nan)
+    if len(times) == 0:
+        return result
+    inside = numpy.flatnonzero((grid >= times[0]) & (grid <= times[-1]))
+    if len(times) == 1:
+        result[...,inside] = values[...,:1]
+        return result
+    points = grid[inside]
+    right = numpy.clip(numpy.searchsorted(times,points,side='right'),1,len(times)-1)
+    left = right - 1
+    span = times[right] - times[left]
+    weight = numpy.where(span > 0,(points - times[left])/numpy.where(span > 0,span,1),0)
+    result[...,inside] = values[...,left] + (values[...,right] - values[...,left])*weight
+    return result
+
+def valueBounds(values, columns=None):
+    '''
+    The smallest and largest values in each row of values (only in the given columns, if any), ignoring NaN; rows
+    without any values get NaN. Big matrices are read MERGE_ROWS rows at a time, so memory-mapped ones are never all
+    in RAM at once.
+    '''
+    lows = numpy.empty(len(values),dtype=numpy.float64)
+    lows.fill(numpy.nan)
+    highs = lows.copy()
+    if len(values) == 0 or (values.shape[1] if columns == None else len(columns)) == 0:
+        return (lows,highs)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning)  # rows that are all NaN
+        for offset in xrange(0,len(values),MERGE_ROWS):
+            chunk = values[offset:offset+MERGE_ROWS]
+            if columns != None:
+                chunk = chunk[:,columns]
+            lows[offset:offset+len(chunk)] = numpy.nanmin(chunk,axis=1)
+            highs[offset:offset+len(chunk)] = numpy.nanmax(chunk,axis=1)
+    return (lows,highs)
+
+def boundsOf(genes, index, lows, highs):
+    '''
+    {gene:(low,high)} for the genes that have any values, given the gene:row index and per-row bounds
+    '''
+    bounds = {}
+    for g in genes:
+        i = index.get(g)
+        if i != None and not numpy.isnan(lows[i]):
+            bounds[g] = (float(lows[i]),float(highs[i]))
+    return bounds
+
+def splitTrajectory(times, values):
+    '''
+    Splits a trajectory into pieces wherever time is undefined or goes backwards (e.g. between the runs of an
+    ensemble); returns a list of (times, values) pieces
+    '''
+    with numpy.errstate(invalid='ignore'):
+        cuts = numpy.flatnonzero(~(times[1:] >= times[:-1])) + 1
+    pieces = []
+    for indices in numpy.split(numpy.arange(len(times)),cuts):
+        indices = indices[numpy.isfinite(times[indices])]
+        if len(indices) > 0:
+            pieces.append((times[indices],values[...,indices]))
+    return pieces
+
+def parseFloat(value):
+    try:
+        return float(value)
+    except ValueError:
+        return numpy.nan
+
+def batchVectors(trajectories, genes, pairs=None):
+    '''
+    Builds (x0,y0,t0,x1,y1,t1) segment arrays for many gene pairs at once. trajectories maps each class
+    to a list of (times, values) tuples, where values has one row per entry in genes and one column per
+    time point. Segments are only made between consecutive points where both genes are defined; a
+    trajectory with a single point yields a zero-length segment. Returns {(x,y):{class:segments}} for
+    every requested pair (all ordered pairs of genes by default).
+    '''
+    rowIndex = {}
+    for i,g in enumerate(genes):
+        rowIndex.setdefault(g,i)
+    if pairs == None:
+        pairs = [(x,y) for x in rowIndex.iterkeys() for y in rowIndex.iterkeys()]
+    xRows = numpy.array([rowIndex[x] for x,y in pairs],dtype=numpy.intp)
+    yRows = numpy.array([rowIndex[y] for x,y in pairs],dtype=numpy.intp)
+    
+    results = dict((pair,{}) for pair in pairs)
+    for c,tracks in trajectories.iteritems():
+        pieces = dict((pair,[]) for pair in pairs)
+        for times,values in tracks:
+            if len(times) == 0:
+                continue
+            if len(times) == 1:
+                start = numpy.zeros(1,dtype=numpy.intp)
+                end = start
+            else:
+                start = numpy.arange(len(times)-1)
+                end = start + 1
+            defined = numpy.isfinite(values)
+            chunk = max(1,BATCH_ELEMENTS // len(times))
+            for offset in xrange(0,len(pairs),chunk):
+                xr = xRows[offset:offset+chunk]
+                yr = yRows[offset:offset+chunk]
+                both = defined[xr] & defined[yr]
+                valid = both[:,start] & both[:,end]
+                segments = numpy.empty(valid.shape + (6,),dtype=numpy.float64)
+                segments[:,:,0] = values[xr][:,start]
+                segments[:,:,1] = values[yr][:,start]
+                segments[:,:,2] = times[start]
+                segments[:,:,3] = values[xr][:,end]
+                segments[:,:,4] = values[yr][:,end]
+                segments[:,:,5] = times[end]
+                for i,pair in enumerate(pairs[offset:offset+chunk]):
+                    pieces[pair].append(segments[i][valid[i]])
+        for pair,p in pieces.iteritems():
+            if len(p) == 1:
+                results[pair][c] = p[0]
+            elif len(p) > 1:
+                results[pair][c] = numpy.vstack(p)
+            else:
+                results[pair][c] = numpy.empty((0,6),dtype=numpy.float64)
+    return results
 
 class SoftVector:
     timeKeys = [re.compile(r'(?:(?P<days>\d+)\s*d[ays]*)?\s*\,*(?:(?P<hours>\d+)\s*h[ours]*)?\s*\,*(?:(?P<minutes>\d+)\s*m[inutes]*)?\s*\,*(?:(?P<seconds>\d+)\s*s[econds]*)?', re.I)]    # will match strings like '12 min 8SECONDS' or '2 m'
@@ -8,8 +321,6 @@ class SoftVector:
         
         self.nextPoint = None
         self.previousPoint = None
-        
-        self.values = {}
     
     def addDescription(self, d):
         setTimepoint = False
@@ -45,7 +356,13 @@ class SoftVector:
             return self.timepoint - other.timepoint
     
 class SoftFile:
-    def __init__(self, path):
+    def __init__(self, path, progress=None, useCache=True, lazy=False):
+        '''
+        Reads .soft or .soft.gz files. If given, progress is called with the fraction of the file read so far.
+        Unless useCache is False, the parsed file is cached, and reloaded from the cache as long as it hasn't changed.
+        In lazy mode (which always uses the cache), the matrix is written straight to the cache while parsing and then
+        memory-mapped, so the whole thing is never in RAM at once; only the gene rows that get plotted are paged in.
+        '''
         self.minTime = None
         self.maxTime = None
         
@@ -53,114 +370,331 @@ class SoftFile:
         self.genes = []
         self.starts = {}
         
-        with open(path,'rb') as infile:
+        # Expression values live in a dense genes x samples matrix (NaN where missing);
+        # geneIndex and sampleIndex map names to rows and columns
+        self.matrix = None
+        self.geneIndex = {}
+        self.sampleIndex = {}
+        # Other names for genes (probe IDs from the ID_REF column, when the table is keyed by IDENTIFIER)
+        self.aliases = {}
+        # For each description, the matrix columns and timepoints of its linked family, in order
+        self.chains = {}
+        # Each gene's smallest and largest value in any family, by matrix row
+        self.lows = numpy.empty(0,dtype=numpy.float64)
+        self.highs = numpy.empty(0,dtype=numpy.float64)
+        
+        if (useCache or lazy) and self.loadCache(path):
+            if progress != None:
+                progress(1.0)
+            return
+        
+        self.tableColumns = None
+        self.tableWidth = 0
+        self.tableGenes = []
+        self.tableAliases = []
+        self.tableBlocks = []
+        self.tableRows = 0
+        self.tableFile = None
+        if lazy:
+            try:
+                invalidateCache(path)
+                self.tableFile = open(newCacheFile(),'wb')  # moved into place once it's complete
+            except (IOError,OSError):
+                lazy = False    # nowhere to put the matrix, so it will have to fit in RAM after all
+        
+        totalSize = os.path.getsize(path)
+        
+        with openFile(path) as infile:
             currentDesc = None
             
-            headerOrder = None
             families = []
             
-            for line in infile:
-                if line.startswith('!subset_description'):
-                    line = line.strip()
-                    currentDesc = line[line.find('=')+2:]
-                elif line.startswith('!subset_sample_id'):
-                    line = line.strip()
-                    line = line[line.find('=')+2:]
-                    assert currentDesc != None
-                    for h in line.split(','):
-                        if not self.data.has_key(h):
-                            self.data[h] = SoftVector()
-                        self.data[h].addDescription(currentDesc)
-                elif len(line) <= 1 or line.startswith('#') or line.startswith('!'):
-                    continue
-                elif line.startswith('^'):
-                    currentDesc = None
-                elif headerOrder == None:
-                    # Group families of data, also get min and max times
-                    for hObj in self.data.itervalues():
-                        if hObj.timepoint != None:
-                            if self.minTime == None:
-                                self.minTime = hObj.timepoint
-                                self.maxTime = hObj.timepoint
-                            else:
-                                self.minTime = min(hObj.timepoint,self.minTime)
-                                self.maxTime = max(hObj.timepoint,self.maxTime)
-                        foundFamily = False
-                        for members in families:
-                            if members[0].isRelated(hObj):
-                                members.append(hObj)
-                                foundFamily = True
-                                break
-                        if not foundFamily:
-                            families.append([hObj])
-                    # Sort and link families
-                    for members in families:
-                        prevObj = None
-                        for hObj in sorted(members):
-                            if prevObj != None:
-                                hObj.previousPoint = prevObj
-                                prevObj.nextPoint = hObj
-                            prevObj = hObj
-                    headerOrder = line.split()[2:]
-                    # Get the starting points for each description
-                    for h,hObj in self.data.iteritems():
-                        for d in hObj.descriptions:
-                            startingPoint = hObj
-                            while startingPoint.previousPoint != None:
-                                startingPoint = startingPoint.previousPoint
-                            if self.starts.has_key(d):
-                                assert (self.starts[d].timepoint == None and startingPoint.timepoint == None) or self.starts[d] == startingPoint
-                            else:
-                                self.starts[d] = startingPoint
+            for lines,position in readBlocks(infile):
+                if self.tableColumns != None:
+                    self.parseTable(lines)
                 else:
-                    columns = line.split('\t')
-                    gene = columns[1]
-                    if gene == 'EMPTY':
-                        continue
-                    self.genes.append(gene)
-                    for i,h in enumerate(headerOrder):
-                        if i+2 >= len(columns):
+                    for i,line in enumerate(lines):
+                        if line.startswith('!subset_description'):
+                            line = line.strip()
+                            currentDesc = line[line.find('=')+2:]
+                        elif line.startswith('!subset_sample_id'):
+                            line = line.strip()
+                            line = line[line.find('=')+2:]
+                            assert currentDesc != None
+                            for h in line.split(','):
+                                if not self.data.has_key(h):
+                                    self.data[h] = SoftVector()
+                                self.data[h].addDescription(currentDesc)
+                        elif len(line.strip()) == 0 or line.startswith('#') or line.startswith('!'):
                             continue
-                        value = columns[i+2]
-                        try:
-                            value = float(value)
-                            self.data[h].values[gene] = value
-                        except:
-                            pass
+                        elif line.startswith('^'):
+                            currentDesc = None
+                        else:
+                            self.parseHeader(line,families)
+                            self.parseTable(lines[i+1:])
+                            break
+                if progress != None and totalSize > 0:
+                    progress(min(1.0,float(position)/totalSize))
         infile.close()
+        
+        self.buildMatrix()
+        tablePath = self.tableFile.name if self.tableFile != None else None
+        del self.tableColumns, self.tableWidth, self.tableGenes, self.tableAliases, self.tableBlocks, self.tableRows, self.tableFile
+        columns = [int(c) for columns,times in self.chains.itervalues() for c in columns if c >= 0]
+        self.lows,self.highs = valueBounds(self.matrix,sorted(set(columns)))
+        
+        if lazy:
+            try:
+                matrixPath = invalidateCache(path)
+                os.rename(tablePath,matrixPath)
+                self.matrix = openMatrix(matrixPath,numpy.float32,self.matrix.shape)
+                writeCacheHeader(path,'SoftFile',self.cacheHeader(),self.matrix)
+            except (IOError,OSError,ValueError):
+                pass
+        elif useCache:
+            writeCache(path,'SoftFile',self.cacheHeader(),self.matrix)
     
-    def getVectors(self, attr1, attr2):
-        vectors = {}
+    def loadCache(self, path):
+        cached = readCache(path,'SoftFile')
+        if cached == None:
+            return False
+        header,self.matrix = cached
+        self.minTime = header['minTime']
+        self.maxTime = header['maxTime']
+        self.genes = header['genes']
+        self.geneIndex = dict((g,i) for i,g in enumerate(self.genes))
+        self.sampleIndex = dict((h,i) for i,h in enumerate(header['samples']))
+        self.aliases = header['aliases']
+        self.lows = numpy.array(header['lows'],dtype=numpy.float64)
+        self.highs = numpy.array(header['highs'],dtype=numpy.float64)
+        for d,(columns,times) in header['chains'].iteritems():
+            self.chains[d] = (numpy.array(columns,dtype=numpy.intp),numpy.array(times,dtype=numpy.float64))
+        return True
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The linked sample objects are only needed while parsing
+        state['data'] = {}
+        state['starts'] = {}
+        state['matrix'] = packMatrix(self.matrix)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.matrix = unpackMatrix(self.matrix)
+    
+    def cacheHeader(self):
+        samples = sorted(self.sampleIndex.iterkeys(),key=self.sampleIndex.get)
+        chains = dict((d,(columns.tolist(),times.tolist())) for d,(columns,times) in self.chains.iteritems())
+        return {'minTime':self.minTime,'maxTime':self.maxTime,'genes':self.genes,'samples':samples,'chains':chains,'aliases':self.aliases,
+                'lows':self.lows.tolist(),'highs':self.highs.tolist()}
+    
+    def parseHeader(self, line, families):
+        '''
+        Called on the table's header row, once all the subsets have been described
+        '''
+        # Group families of data, also get min and max times
+        for hObj in self.data.itervalues():
+            if hObj.timepoint != None:
+                if self.minTime == None:
+                    self.minTime = hObj.timepoint
+                    self.maxTime = hObj.timepoint
+                else:
+                    self.minTime = min(hObj.timepoint,self.minTime)
+                    self.maxTime = max(hObj.timepoint,self.maxTime)
+            foundFamily = False
+            for members in families:
+                if members[0].isRelated(hObj):
+                    members.append(hObj)
+                    foundFamily = True
+                    break
+            if not foundFamily:
+                families.append([hObj])
+        # Sort and link families
+        for members in families:
+            prevObj = None
+            for hObj in sorted(members):
+                if prevObj != None:
+                    hObj.previousPoint = prevObj
+                    prevObj.nextPoint = hObj
+                prevObj = hObj
+        # Only keep the columns that are actually samples (full files have annotation columns at the end)
+        self.tableColumns = []
+        header = line.strip().split('\t')
+        self.tableWidth = len(header)
+        for i,h in enumerate(header):
+            if i >= 2 and self.data.has_key(h):
+                self.sampleIndex[h] = len(self.tableColumns)
+                self.tableColumns.append(i)
+        # Get the starting points for each description
+        for h,hObj in self.data.iteritems():
+            for d in hObj.descriptions:
+                startingPoint = hObj
+                while startingPoint.previousPoint != None:
+                    startingPoint = startingPoint.previousPoint
+                if self.starts.has_key(d):
+                    assert (self.starts[d].timepoint == None and startingPoint.timepoint == None) or self.starts[d] == startingPoint
+                else:
+                    self.starts[d] = startingPoint
+        # Flatten each family into a list of columns (-1 for samples without data) and timepoints
+        samples = dict((id(hObj),h) for h,hObj in self.data.iteritems())
         for d,hObj in self.starts.iteritems():
-            vectors[d] = []
-            x = hObj.values.get(attr1)
-            y = hObj.values.get(attr2)
-            t = hObj.timepoint
-            if hObj.nextPoint == None:
-                if x != None and y != None:
-                    vectors[d].append((x,y,t,x,y,t))
-            else:
-                lastX = x
-                lastY = y
-                lastT = t
-                currentObj = hObj
-                while currentObj.nextPoint != None:
-                    currentObj = currentObj.nextPoint
-                    x = currentObj.values.get(attr1)
-                    y = currentObj.values.get(attr2)
-                    t = currentObj.timepoint
-                    if lastX != None and lastY != None and x != None and y != None:
-                        vectors[d].append((lastX,lastY,lastT,x,y,t))
-                    lastX = x
-                    lastY = y
-                    lastT = t
-        return vectors
+            columns = []
+            times = []
+            while hObj != None:
+                columns.append(self.sampleIndex.get(samples[id(hObj)],-1))
+                times.append(numpy.nan if hObj.timepoint == None else hObj.timepoint)
+                hObj = hObj.nextPoint
+            self.chains[d] = (numpy.array(columns,dtype=numpy.intp),numpy.array(times,dtype=numpy.float64))
+    
+    def parseTable(self, lines):
+        '''
+        Converts a block of data table rows to a float32 array in one go: the value columns of every row are joined
+        into one string, missing values are replaced with nan, and numpy tokenizes the lot (as in readTsd)
+        '''
+        if len(self.tableColumns) == 0:
+            return
+        width = self.tableColumns[-1] + 1
+        extra = self.tableWidth - width # annotation columns after the last sample
+        rows = [line.rstrip('\r').split('\t',2) for line in lines if len(line) > 0 and line[0] not in '!#^']
+        rows = [r for r in rows if len(r) > 1 and r[1] != 'EMPTY']
+        if len(rows) == 0:
+            return
+        self.tableGenes.extend(map(operator.itemgetter(1),rows))
+        self.tableAliases.extend(map(operator.itemgetter(0),rows))
+        
+        if extra > 0:
+            values = [r[2].rsplit('\t',extra)[0] if len(r) > 2 else '' for r in rows]
+        else:
+            values = [r[2] if len(r) > 2 else '' for r in rows]
+        # Every cell ends up between two tabs, so missing values can be replaced as whole cells (twice, because
+        # neighbouring cells share a tab). Searching all of the text for every token is slow, so only the tokens
+        # that show up among the characters numbers don't use, and those made of characters numbers do use
+        # ('' and '-'), are looked for.
+        text = '\t%s\t' % '\t\n\t'.join(values)
+        del values
+        others = text.translate(None,'0123456789.eE+-\t\n')
+        for token in MISSING_VALUES:
+            if (len(token.strip('-')) == 0 or token in others) and '\t%s\t' % token in text:
+                for i in xrange(2):
+                    text = text.replace('\t%s\t' % token,'\tnan\t')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',DeprecationWarning)  # numpy stops (and warns) at anything non-numeric
+            block = numpy.fromstring(text.translate(TABLE_SEPARATORS),dtype=numpy.float32,sep=' ')
+        del text
+        
+        if len(block) == len(rows)*(width-2):
+            block = block.reshape(len(rows),width-2)
+            if len(self.tableColumns) < width-2:
+                block = block[:,numpy.array(self.tableColumns,dtype=numpy.intp)-2]
+        else:
+            # Something non-numeric that we don't know about (in a sample column, or in a column between them that
+            # isn't a sample), or rows of different lengths; fall back to converting cell by cell
+            cells = []
+            for r in rows:
+                r = r[:2] + (r[2].split('\t',width-2) if len(r) > 2 else [])
+                if len(r) < width:
+                    r.extend([''] * (width - len(r)))
+                cells.append(r)
+            cells = numpy.array(map(operator.itemgetter(*self.tableColumns),cells),dtype=numpy.string_).reshape(len(rows),len(self.tableColumns))
+            block = numpy.vectorize(parseFloat,otypes=[numpy.float32])(cells)
+        if self.tableFile != None:
+            block.tofile(self.tableFile)
+        else:
+            self.tableBlocks.append(block)
+        self.tableRows += len(block)
+    
+    def buildMatrix(self):
+        '''
+        Turns the parsed table rows into one genes x samples matrix. Repeated identifiers (several probes for one
+        gene) share a row, where later values overwrite earlier ones. In lazy mode, everything stays on disk.
+        '''
+        if self.tableFile != None:
+            self.tableFile.close()
+            values = openMatrix(self.tableFile.name,numpy.float32,(self.tableRows,len(self.sampleIndex)))
+        elif len(self.tableBlocks) > 0:
+            values = numpy.vstack(self.tableBlocks)
+        else:
+            values = numpy.empty((0,len(self.sampleIndex)),dtype=numpy.float32)
+        self.tableBlocks = []
+        
+        geneIndex = self.geneIndex
+        targets = numpy.array([geneIndex.setdefault(g,len(geneIndex)) for g in self.tableGenes],dtype=numpy.intp)
+        self.genes = [None] * len(geneIndex)
+        for g,i in geneIndex.iteritems():
+            self.genes[i] = g
+        self.aliases = dict((a,g) for a,g in zip(self.tableAliases,self.tableGenes) if a != g and not geneIndex.has_key(a))
+        
+        if len(self.genes) == len(targets):
+            self.matrix = values
+            return
+        # Rank each line among the lines for the same gene, and apply one rank at a time
+        order = numpy.argsort(targets,kind='mergesort')
+        sortedTargets = targets[order]
+        firsts = numpy.ones(len(targets),dtype=bool)
+        firsts[1:] = sortedTargets[1:] != sortedTargets[:-1]
+        groupStarts = numpy.maximum.accumulate(numpy.where(firsts,numpy.arange(len(targets)),0))
+        occurrences = numpy.empty(len(targets),dtype=numpy.intp)
+        occurrences[order] = numpy.arange(len(targets)) - groupStarts
+        
+        onDisk = isinstance(values,numpy.memmap)
+        if onDisk:
+            self.matrix = openMatrix(values.filename + '.tmp',numpy.float32,(len(self.genes),values.shape[1]),'w+')
+        else:
+            self.matrix = numpy.empty((len(self.genes),values.shape[1]),dtype=numpy.float32)
+        self.matrix.fill(numpy.nan)
+        for k in xrange(occurrences.max() + 1):
+            lines = numpy.flatnonzero(occurrences == k)
+            for offset in xrange(0,len(lines),MERGE_ROWS):
+                chunk = lines[offset:offset+MERGE_ROWS]
+                rows = targets[chunk]
+                current = self.matrix[rows]
+                update = values[chunk]
+                defined = numpy.isfinite(update)
+                current[defined] = update[defined]
+                self.matrix[rows] = current
+        if onDisk:
+            # Swap the merged matrix in for the raw rows
+            self.matrix.flush()
+            path = values.filename
+            del values
+            self.matrix = None
+            os.remove(path)
+            os.rename(path + '.tmp',path)
+            self.matrix = openMatrix(path,numpy.float32,(len(self.genes),len(self.sampleIndex)))
+    
+    def getTrajectories(self, genes):
+        '''
+        For each description, the timepoints of its family and a len(genes) x timepoints array of values
+        (NaN where a gene or sample is missing)
+        '''
+        rows = numpy.array([self.geneIndex.get(g,-1) for g in genes],dtype=numpy.intp)
+        trajectories = {}
+        for d,(columns,times) in self.chains.iteritems():
+            values = numpy.empty((len(rows),len(columns)),dtype=numpy.float32)
+            values.fill(numpy.nan)
+            present = numpy.ix_(rows >= 0,columns >= 0)
+            values[present] = self.matrix[numpy.ix_(rows[rows >= 0],columns[columns >= 0])]
+            trajectories[d] = [(times,values)]
+        return trajectories
+    
+    def getVectors(self, attr1, attr2):
+        return self.getVectorsBatch([attr1,attr2],[(attr1,attr2)])[(attr1,attr2)]
+    
+    def getVectorsBatch(self, genes, pairs=None):
+        return batchVectors(self.getTrajectories(genes),genes,pairs)
     
     def geneList(self):
         return self.genes
     
+    def geneBounds(self, genes):
+        return boundsOf(genes,self.geneIndex,self.lows,self.highs)
+    
+    def aliasMap(self):
+        return self.aliases
+    
     def classList(self):
-        return self.starts.keys()
+        return self.chains.keys()
     
     def timeRange(self):
         return (self.minTime,self.maxTime)
@@ -169,63 +703,298 @@ class TsdFile:
     '''
     Assumes time points are in seconds, requires 'time' to be the first column header
     '''
-    def __init__(self, path):
+    def __init__(self, path, useCache=True):
         self.minTime = None
         self.maxTime = None
         self.classes = [os.path.splitext(os.path.split(path)[1])[0]]  # for .tsd files, there's only one class, so we'll use the file name
-        with open(path,'rb') as infile:
-            allData = infile.read().strip()
-            allData = allData[1:-1].replace(')','') # lose the outer parentheses, closing inner parentheses
-            self.rows = allData.split(',(')  # we can split each row by the remaining parenthesis
-            self.genes = self.rows[0][1:].replace('"','') # There's one remaining open parenthesis that didn't have a comma before it... but it's in the header, from which we also want to remove the quotes
-            self.genes = self.genes.strip().split(',')
-            self.genes[0] = 'time'
-            self.rows = self.rows[1:]
-            for i,r in enumerate(self.rows):
-                self.rows[i] = r.split(',')
-                for j,c in enumerate(self.rows[i]):
-                    self.rows[i][j] = float(c.strip())
-                    if j == 0:
-                        if self.minTime == None:
-                            self.minTime = self.rows[i][j]
-                            self.maxTime = self.rows[i][j]
-                        else:
-                            self.minTime = min(self.minTime,self.rows[i][j])
-                            self.maxTime = max(self.maxTime,self.rows[i][j])
-        infile.close()
+        if useCache and self.loadCache(path):
+            return
+        self.genes,self.rows = readTsd(path)
+        if len(self.rows) > 0:
+            self.minTime = float(self.rows[0,0])
+            self.maxTime = float(self.rows[-1,0])
+        self.geneIndex = dict((g,i) for i,g in enumerate(self.genes))
+        self.lows,self.highs = valueBounds(self.rows.T)
+        
+        if useCache:
+            writeCache(path,'TsdFile',{'minTime':self.minTime,'maxTime':self.maxTime,'genes':self.genes,
+                                       'lows':self.lows.tolist(),'highs':self.highs.tolist()},self.rows)
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['rows'] = packMatrix(self.rows)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rows = unpackMatrix(self.rows)
+    
+    def loadCache(self, path):
+        cached = readCache(path,'TsdFile')
+        if cached == None:
+            return False
+        header,self.rows = cached
+        self.minTime = header['minTime']
+        self.maxTime = header['maxTime']
+        self.genes = header['genes']
+        self.geneIndex = dict((g,i) for i,g in enumerate(self.genes))
+        self.lows = numpy.array(header['lows'],dtype=numpy.float64)
+        self.highs = numpy.array(header['highs'],dtype=numpy.float64)
+        return True
+    
+    def getTrajectories(self, genes):
+        '''
+        The single trajectory of this run: its time column and a len(genes) x rows array of values
+        '''
+        values = numpy.empty((len(genes),len(self.rows)),dtype=numpy.float64)
+        values.fill(numpy.nan)
+        for i,g in enumerate(genes):
+            if self.geneIndex.has_key(g):
+                values[i] = self.rows[:,self.geneIndex[g]]
+        return {self.classes[0]:[(self.rows[:,0],values)]}
     
     def getVectors(self, attr1, attr2):
-        if not attr1 in self.genes or not attr2 in self.genes:
-            return {}
+        return self.getVectorsBatch([attr1,attr2],[(attr1,attr2)])[(attr1,attr2)]
+    
+    def getVectorsBatch(self, genes, pairs=None):
+        return batchVectors(self.getTrajectories(genes),genes,pairs)
+    
+    def geneList(self):
+        return self.genes[1:]   # don't include time
+    
+    def geneBounds(self, genes):
+        return boundsOf(genes,self.geneIndex,self.lows,self.highs)
+    
+    def aliasMap(self):
+        return {}
+    
+    def classList(self):
+        return self.classes
+    
+    def timeRange(self):
+        return (self.minTime,self.maxTime)
+
+class TsdEnsemble:
+    '''
+    Many .tsd runs of the same model (e.g. all the stochastic runs in a directory) as one data source, stored in a
+    runs x time x species array. By default all the runs make up one class named after the directory; if pattern is
+    given, runs are grouped by the regular expression's first group (or whole match) against the run's file name.
+    '''
+    SUMMARY_POINTS = 200
+    SUMMARY_PERCENTILES = [10,90]
+    
+    def __init__(self, path, pattern=None, summary=False, progress=None):
+        '''
+        In summary mode, only the per-timepoint mean, median and SUMMARY_PERCENTILES of each class are kept (computed
+        across runs after resampling them onto a common time grid), so drawing costs the same however many runs there are.
+        If given, progress is called with the fraction of the runs read so far.
+        '''
+        self.minTime = None
+        self.maxTime = None
+        self.name = os.path.basename(os.path.normpath(path))
         
-        diffs = []
+        paths = sorted(os.path.join(path,f) for f in os.listdir(path) if f.lower().endswith('.tsd') or f.lower().endswith('.tsd.gz'))
+        if len(paths) == 0:
+            raise ValueError('No .tsd files found in %s' % path)
+        self.runs = []
+        runData = []
+        self.genes = ['time']
+        self.geneIndex = {'time':0}
+        for i,p in enumerate(paths):
+            genes,rows = readTsd(p)
+            for g in genes:
+                if not self.geneIndex.has_key(g):
+                    self.geneIndex[g] = len(self.genes)
+                    self.genes.append(g)
+            self.runs.append(os.path.basename(p).split('.')[0])
+            runData.append((genes,rows))
+            if progress != None:
+                progress(float(i+1)/len(paths))
         
-        c1 = self.genes.index(attr1)
-        c2 = self.genes.index(attr2)
+        # Pad every run with at least one row of NaN, so that flattening the runs end to end never connects two runs
+        numRows = max(len(rows) for genes,rows in runData) + 1
+        self.data = numpy.empty((len(runData),numRows,len(self.genes)),dtype=numpy.float64)
+        self.data.fill(numpy.nan)
+        for r,(genes,rows) in enumerate(runData):
+            self.data[r,:len(rows)][:,[self.geneIndex[g] for g in genes]] = rows
+        del runData
+        if numpy.any(numpy.isfinite(self.data[:,:,0])):
+            self.minTime = float(numpy.nanmin(self.data[:,:,0]))
+            self.maxTime = float(numpy.nanmax(self.data[:,:,0]))
         
-        lastX = None
-        lastY = None
-        lastT = None
-        for r in self.rows:
-            x = r[c1]
-            y = r[c2]
-            t = r[0]
-            if lastX != None and lastY != None and lastT != None:
-                diffs.append((lastX,lastY,lastT,x,y,t))
-            lastX = x
-            lastY = y
-            lastT = t
-        return {self.classes[0]:diffs}
+        self.groups = {}
+        if pattern != None:
+            pattern = re.compile(pattern)
+        for r,run in enumerate(self.runs):
+            c = self.name
+            if pattern != None:
+                m = pattern.search(run)
+                if m != None:
+                    c = m.group(1) if m.groups() and m.group(1) != None else m.group(0)
+            self.groups.setdefault(c,[]).append(r)
+        for c in self.groups.iterkeys():
+            self.groups[c] = numpy.array(self.groups[c],dtype=numpy.intp)
+        
+        self.summary = None
+        if summary:
+            self.summarize()
+        else:
+            self.lows,self.highs = valueBounds(self.data.reshape(-1,len(self.genes)).T)
+    
+    def summarize(self):
+        '''
+        Replaces the runs with statistics across the runs of each class, at SUMMARY_POINTS evenly spaced times
+        '''
+        self.summary = {}
+        if self.minTime == None:
+            grid = numpy.empty(0,dtype=numpy.float64)
+        else:
+            grid = numpy.linspace(self.minTime,self.maxTime,TsdEnsemble.SUMMARY_POINTS)
+        for c,runs in self.groups.iteritems():
+            resampled = numpy.empty((len(runs),len(self.genes),len(grid)),dtype=numpy.float64)
+            for i,r in enumerate(runs):
+                resampled[i] = resample(self.data[r,:,0],self.data[r].T,grid)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore',RuntimeWarning)  # times that no run in the class reaches are expected
+                self.summary['%s mean' % c] = (grid,numpy.nanmean(resampled,axis=0))
+                self.summary['%s median' % c] = (grid,numpy.nanmedian(resampled,axis=0))
+                for p in TsdEnsemble.SUMMARY_PERCENTILES:
+                    self.summary['%s %ith percentile' % (c,p)] = (grid,numpy.nanpercentile(resampled,p,axis=0))
+        self.data = None
+        
+        self.lows = numpy.empty(len(self.genes),dtype=numpy.float64)
+        self.lows.fill(numpy.nan)
+        self.highs = self.lows.copy()
+        for grid,statistic in self.summary.itervalues():
+            lows,highs = valueBounds(statistic)
+            self.lows = numpy.fmin(self.lows,lows)
+            self.highs = numpy.fmax(self.highs,highs)
+    
+    def getTrajectories(self, genes):
+        '''
+        Each class is one long trajectory: its runs laid end to end, separated by the NaN padding
+        '''
+        columns = numpy.array([self.geneIndex.get(g,-1) for g in genes],dtype=numpy.intp)
+        trajectories = {}
+        if self.summary != None:
+            for c,(grid,statistic) in self.summary.iteritems():
+                values = numpy.empty((len(columns),len(grid)),dtype=numpy.float64)
+                values.fill(numpy.nan)
+                values[columns >= 0] = statistic[columns[columns >= 0]]
+                trajectories[c] = [(grid,values)]
+            return trajectories
+        for c,runs in self.groups.iteritems():
+            if len(runs) == len(self.runs):
+                flat = self.data.reshape(-1,len(self.genes))
+            else:
+                flat = self.data[runs].reshape(-1,len(self.genes))
+            values = numpy.empty((len(columns),len(flat)),dtype=numpy.float64)
+            values.fill(numpy.nan)
+            values[columns >= 0] = flat[:,columns[columns >= 0]].T
+            trajectories[c] = [(flat[:,0],values)]
+        return trajectories
+    
+    def getVectors(self, attr1, attr2):
+        return self.getVectorsBatch([attr1,attr2],[(attr1,attr2)])[(attr1,attr2)]
+    
+    def getVectorsBatch(self, genes, pairs=None):
+        return batchVectors(self.getTrajectories(genes),genes,pairs)
     
     def geneList(self):
         return self.genes[1:]   # don't include time
     
+    def geneBounds(self, genes):
+        return boundsOf(genes,self.geneIndex,self.lows,self.highs)
+    
+    def aliasMap(self):
+        return {}
+    
     def classList(self):
-        return self.classes
+        if self.summary != None:
+            return self.summary.keys()
+        return self.groups.keys()
     
     def timeRange(self):
         return (self.minTime,self.maxTime)
 
+class ResampledSource:
+    '''
+    Wraps another data source, linearly interpolating every trajectory onto a shared time grid, so that sources with
+    different sampling (e.g. SOFT timepoints and simulator time steps) line up point for point. Resampled genes are
+    cached until the grid changes. Trajectories without any timepoints are passed through as they are.
+    '''
+    def __init__(self, source, grid):
+        self.source = source
+        self.setGrid(grid)
+    
+    def setGrid(self, grid):
+        grid = numpy.asarray(grid,dtype=numpy.float64)
+        if hasattr(self,'grid') and numpy.array_equal(grid,self.grid):
+            return
+        self.grid = grid
+        self.times = None
+        self.cache = {}
+    
+    def resampleGenes(self, genes):
+        self.times = {}
+        columns = {}
+        for c,tracks in self.source.getTrajectories(genes).iteritems():
+            times = []
+            pieces = []
+            for trackTimes,values in tracks:
+                if not numpy.any(numpy.isfinite(trackTimes)):
+                    times.append(trackTimes)
+                    pieces.append(values)
+                else:
+                    for t,v in splitTrajectory(trackTimes,values):
+                        times.append(self.grid)
+                        pieces.append(resample(t,v,self.grid))
+                # A NaN column keeps the pieces from being joined
+                times.append(numpy.array([numpy.nan]))
+                pieces.append(numpy.empty((len(genes),1)))
+                pieces[-1].fill(numpy.nan)
+            if len(times) > 0:
+                self.times[c] = numpy.concatenate(times)
+                columns[c] = numpy.hstack(pieces)
+            else:
+                self.times[c] = numpy.empty(0,dtype=numpy.float64)
+                columns[c] = numpy.empty((len(genes),0),dtype=numpy.float64)
+        for i,g in enumerate(genes):
+            self.cache[g] = dict((c,values[i]) for c,values in columns.iteritems())
+    
+    def getTrajectories(self, genes):
+        missing = [g for g in set(genes) if not self.cache.has_key(g)]
+        if len(missing) > 0 or self.times == None:
+            self.resampleGenes(missing)
+        trajectories = {}
+        for c,times in self.times.iteritems():
+            values = numpy.empty((len(genes),len(times)),dtype=numpy.float64)
+            for i,g in enumerate(genes):
+                values[i] = self.cache[g][c]
+            trajectories[c] = [(times,values)]
+        return trajectories
+    
+    def getVectors(self, attr1, attr2):
+        return self.getVectorsBatch([attr1,attr2],[(attr1,attr2)])[(attr1,attr2)]
+    
+    def getVectorsBatch(self, genes, pairs=None):
+        return batchVectors(self.getTrajectories(genes),genes,pairs)
+    
+    def geneList(self):
+        return self.source.geneList()
+    
+    def geneBounds(self, genes):
+        return self.source.geneBounds(genes)    # interpolated values never go beyond the originals
+    
+    def aliasMap(self):
+        return self.source.aliasMap()
+    
+    def classList(self):
+        return self.source.classList()
+    
+    def timeRange(self):
+        return self.source.timeRange()
+
 class CsvFile:
     def __init__(self, path):
         pass
@@ -236,6 +1005,12 @@ class CsvFile:
     def geneList(self):
         pass
     
+    def geneBounds(self, genes):
+        pass
+    
+    def aliasMap(self):
+        pass
+    
     def classList(self):
         pass
     
@@ -252,6 +1027,12 @@ class DatFile:
     def geneList(self):
         pass
     
+    def geneBounds(self, genes):
+        pass
+    
+    def aliasMap(self):
+        pass
+    
     def classList(self):
         pass
     
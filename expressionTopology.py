@@ -1,12 +1,23 @@
 #!/usr/bin/env python
-import sys, os, math
-from PySide.QtGui import QApplication, QGraphicsScene, QGraphicsItem, QPen, QFont, QBrush, QCompleter, QTableWidgetItem, QColorDialog, QFileDialog, QMessageBox
-from PySide.QtCore import Qt, QFile, QRectF, QTimer
+import sys, os, math, time, multiprocessing, argparse, bisect
+from collections import OrderedDict
+import numpy
+from PySide.QtGui import QApplication, QGraphicsScene, QGraphicsView, QGraphicsItem, QPen, QFont, QBrush, QCompleter, QTableWidgetItem, QColorDialog, QFileDialog, QMessageBox, QProgressDialog, QInputDialog, QPixmap, QPainter, QPainterPath, QColor, QTransform
+from PySide.QtCore import Qt, QFile, QRectF, QTimer, QLineF
 from PySide.QtUiTools import QUiLoader
-from expressionFiles import SoftFile, TsdFile
+from expressionFiles import loadSource, TsdEnsemble, ResampledSource
+import glSegments
+from geneSearch import GeneSearch, GeneListModel
 
 class parametricPulseGraph(QGraphicsItem):
     COLOR_MAP = {}
+    COLOR_VERSION = 0   # bumped whenever COLOR_MAP changes, so tiles know to redraw their static layers
+    PEN_CACHE = {}
+    
+    USE_OPENGL = False  # draw segments from vertex buffers with glSegments; the view needs an OpenGL viewport
+    
+    PAINT_COUNT = 0     # tile paints, and the seconds spent in them, for the frame rate readout
+    PAINT_TIME = 0.0
     
     SPEED_LIMIT = 0.25  # we can only step through a quarter of the data at a time
     SLICE_PROPORTION = 0.1
@@ -18,6 +29,9 @@ class parametricPulseGraph(QGraphicsItem):
     
     FULL_SIZE = 400
     SMALL_SIZE = 100
+    DETAIL_PIXELS = 1.0   # small tiles merge consecutive points that fall within the same cell of this size
+    DECIMATED_SEGMENTS = 10000  # most segments per class in a small tile; beyond this, the cells are made coarser
+    DECIMATED_TIMES = 20    # stretches of the time range that segments between the same two cells are merged within
     
     LABEL_THRESHOLD = 150
     
@@ -37,7 +51,11 @@ class parametricPulseGraph(QGraphicsItem):
     BACKGROUND = QBrush(Qt.black)
     BACKGROUND_OPACITY = 0.9
     
-    def __init__(self, parent, xAttribute, yAttribute, vectors=None):
+    def __init__(self, parent, xAttribute, yAttribute, vectors=None, bounds=None):
+        '''
+        bounds, if known, is (xmin,xmax,ymin,ymax) for the two genes (see mergeBounds); otherwise it is found by
+        scanning every segment
+        '''
         QGraphicsItem.__init__(self)
         self.parent = parent
         self.xAttribute = xAttribute
@@ -56,21 +74,38 @@ class parametricPulseGraph(QGraphicsItem):
         self.width = parametricPulseGraph.FULL_SIZE
         self.height = parametricPulseGraph.FULL_SIZE
         
+        self.staticLayer = None
+        self.staticKey = None
+        self.lines = None
+        self.linesKey = None
+        self.timeIndex = None
+        self.smallVectors = None
+        self.smallTimeIndex = None
+        self.slicePainted = False   # whether the last paint drew any of the time slice
+        self.glBuffers = None
+        self.swapped = False    # true if the vectors are stored as (y,x) rather than (x,y), shared with the transposed tile
+        
         if self.vectors == None:
             return
         
         for vlist in self.vectors.itervalues():
-            for x0,y0,t0,x1,y1,t1 in vlist:
-                if self.xmin == None:
-                    self.xmin = min(x0,x1)
-                    self.xmax = max(x0,x1)
-                    self.ymin = min(y0,y1)
-                    self.ymax = max(y0,y1)
-                else:
-                    self.xmin = min(self.xmin,x0,x1)
-                    self.xmax = max(self.xmax,x0,x1)
-                    self.ymin = min(self.ymin,y0,y1)
-                    self.ymax = max(self.ymax,y0,y1)
+            if len(vlist) == 0:
+                continue
+            if bounds != None:
+                self.xmin,self.xmax,self.ymin,self.ymax = bounds
+                break
+            xs = vlist[:,(0,3)]
+            ys = vlist[:,(1,4)]
+            if self.xmin == None:
+                self.xmin = xs.min()
+                self.xmax = xs.max()
+                self.ymin = ys.min()
+                self.ymax = ys.max()
+            else:
+                self.xmin = min(self.xmin,xs.min())
+                self.xmax = max(self.xmax,xs.max())
+                self.ymin = min(self.ymin,ys.min())
+                self.ymax = max(self.ymax,ys.max())
         
         if self.xmin == None or self.xmax == None or self.ymin == None or self.ymax == None:
             self.xmin = None
@@ -78,86 +113,361 @@ class parametricPulseGraph(QGraphicsItem):
             self.ymin = None
             self.ymax = None
             self.vectors = None
+        else:
+            decimated = self.decimate(parametricPulseGraph.SMALL_SIZE,parametricPulseGraph.SMALL_SIZE)
+            self.smallVectors,self.smallTimeIndex = parametricPulseGraph.indexTimes(decimated)
+            self.vectors,self.timeIndex = parametricPulseGraph.indexTimes(self.vectors)
     
-    def paint(self, painter, option, widget=None):
-        normalRect = QRectF(0,0,self.width,self.height)
-        rotatedRect = QRectF(0,-self.height,self.width,self.height)
+    def transposed(self):
+        '''
+        The tile for (yAttribute,xAttribute), drawing this tile's segments with x and y swapped instead of copying them
+        '''
+        tile = parametricPulseGraph(self.parent,self.yAttribute,self.xAttribute)
+        tile.shareTransposed(self)
+        return tile
+    
+    def shareTransposed(self, other):
+        '''
+        Points this tile at the segments of other, its transpose, again after other's data has changed
+        '''
+        self.vectors = other.vectors
+        self.timeIndex = other.timeIndex
+        self.smallVectors = other.smallVectors
+        self.smallTimeIndex = other.smallTimeIndex
+        self.xmin,self.xmax = other.ymin,other.ymax
+        self.ymin,self.ymax = other.xmin,other.xmax
+        self.swapped = not other.swapped
+    
+    def setBounds(self, bounds):
+        '''
+        Widens the axes to bounds, (xmin,xmax,ymin,ymax), e.g. when more data for the tile's genes has been loaded;
+        they never shrink, so the decimated segments stay fine enough
+        '''
+        if bounds == None or self.vectors == None:
+            return
+        xmin,xmax,ymin,ymax = bounds
+        widened = (min(self.xmin,xmin),max(self.xmax,xmax),min(self.ymin,ymin),max(self.ymax,ymax))
+        if widened != (self.xmin,self.xmax,self.ymin,self.ymax):
+            self.xmin,self.xmax,self.ymin,self.ymax = widened
+            self.invalidate()
+    
+    def addVectors(self, vectors, bounds=None):
+        '''
+        Adds the classes from a newly loaded source (replacing any of the same name, as getVectorsBatch would),
+        decimating and indexing only the new segments. The bounds only ever grow, so the decimation of the classes
+        that were already here stays at least as fine as it needs to be. Returns whether anything changed.
+        '''
+        if self.swapped:
+            stored = dict((cat,vlist[:,(1,0,2,4,3,5)]) for cat,vlist in vectors.iteritems())
+            if bounds != None:
+                bounds = bounds[2:] + bounds[:2]
+            added = parametricPulseGraph(self.parent,self.yAttribute,self.xAttribute,stored,bounds).transposed()
+        else:
+            added = parametricPulseGraph(self.parent,self.xAttribute,self.yAttribute,vectors,bounds)
+        if added.vectors == None:
+            return False
         
-        if self.isTop or self.isLeft or self.isRight or self.isBottom:
-            painter.setFont(parametricPulseGraph.LABEL_FONT)
-            painter.setPen(parametricPulseGraph.LABEL_PEN)
-            painter.setOpacity(parametricPulseGraph.LABEL_OPACITY)
+        if self.vectors == None:
+            self.vectors = added.vectors
+            self.timeIndex = added.timeIndex
+            self.smallVectors = added.smallVectors
+            self.smallTimeIndex = added.smallTimeIndex
+            self.xmin,self.xmax,self.ymin,self.ymax = added.xmin,added.xmax,added.ymin,added.ymax
+        else:
+            # New dicts rather than updating the old ones, which the transposed tile still draws from
+            self.vectors = dict(self.vectors)
+            self.vectors.update(added.vectors)
+            self.timeIndex = dict(self.timeIndex)
+            self.timeIndex.update(added.timeIndex)
+            self.smallVectors = dict(self.smallVectors)
+            self.smallVectors.update(added.smallVectors)
+            self.smallTimeIndex = dict(self.smallTimeIndex)
+            self.smallTimeIndex.update(added.smallTimeIndex)
+            self.xmin = min(self.xmin,added.xmin)
+            self.xmax = max(self.xmax,added.xmax)
+            self.ymin = min(self.ymin,added.ymin)
+            self.ymax = max(self.ymax,added.ymax)
+        self.invalidate()
+        return True
+    
+    def decimate(self, width, height):
+        '''
+        A coarser copy of self.vectors for drawing at width x height: consecutive points of a trajectory that
+        land in the same DETAIL_PIXELS cell are merged, then segments joining the same two cells at about the same
+        time (see bucketSegments) become one, so noisy trajectories that keep revisiting the same pixels cost no
+        more than smooth ones. Needs the segments in their original (trajectory) order.
+        '''
+        if self.xmax == self.xmin:
+            xScale = 0.0
+        else:
+            xScale = width/((self.xmax-self.xmin)*parametricPulseGraph.DETAIL_PIXELS)
+        if self.ymax == self.ymin:
+            yScale = 0.0
+        else:
+            yScale = height/((self.ymax-self.ymin)*parametricPulseGraph.DETAIL_PIXELS)
+        
+        decimated = {}
+        for cat,vlist in self.vectors.iteritems():
+            if len(vlist) == 0:
+                decimated[cat] = vlist
+                continue
+            # A segment continues a trajectory if it starts where the previous one ended
+            chainStart = numpy.ones(len(vlist),dtype=bool)
+            chainStart[1:] = (vlist[1:,0:3] != vlist[:-1,3:6]).any(axis=1)
+            chainEnd = numpy.ones(len(vlist),dtype=bool)
+            chainEnd[:-1] = chainStart[1:]
             
-            if self.isTop:
-                labelRect = QRectF(-self.height,-self.width,self.height-parametricPulseGraph.LABEL_PADDING,self.width)
-                painter.rotate(90)
-                painter.drawText(labelRect, Qt.AlignRight | Qt.AlignVCenter, self.xAttribute)
-                painter.rotate(-90)
-            if self.isBottom:
-                labelRect = QRectF(self.height+parametricPulseGraph.LABEL_PADDING,-self.width,self.height,self.width)
-                painter.rotate(90)
-                painter.drawText(labelRect, Qt.AlignLeft | Qt.AlignVCenter, self.xAttribute)
-                painter.rotate(-90)
-            if self.isLeft:
-                labelRect = QRectF(-self.width,0,self.width-parametricPulseGraph.LABEL_PADDING,self.height)
-                painter.drawText(labelRect, Qt.AlignRight | Qt.AlignVCenter, self.yAttribute)
-            if self.isRight:
-                labelRect = QRectF(self.width+parametricPulseGraph.LABEL_PADDING,0,self.width,self.height)
-                painter.drawText(labelRect, Qt.AlignLeft | Qt.AlignVCenter, self.yAttribute)
+            # Keep the end of a segment if it leaves its starting cell, or if it ends the trajectory
+            startCells = numpy.floor(numpy.column_stack(((vlist[:,0]-self.xmin)*xScale,(vlist[:,1]-self.ymin)*yScale)))
+            endCells = numpy.floor(numpy.column_stack(((vlist[:,3]-self.xmin)*xScale,(vlist[:,4]-self.ymin)*yScale)))
+            kept = numpy.flatnonzero(chainEnd | (startCells != endCells).any(axis=1))
+            
+            # Each kept end joins up with the previous kept end, or with the start of its trajectory
+            firsts = numpy.flatnonzero(chainStart)
+            first = firsts[numpy.cumsum(chainStart)[kept]-1]
+            previous = numpy.empty(len(kept),dtype=numpy.intp)
+            previous[0] = -1
+            previous[1:] = kept[:-1]
+            fromStart = previous < first
+            merged = numpy.empty((len(kept),6),dtype=numpy.float64)
+            merged[:,0:3] = numpy.where(fromStart[:,numpy.newaxis],vlist[first,0:3],vlist[previous,3:6])
+            merged[:,3:6] = vlist[kept,3:6]
+            
+            # Coarsen the cells until there are at most DECIMATED_SEGMENTS segments
+            cellSize = 1
+            while True:
+                bucketed = parametricPulseGraph.bucketSegments(merged,self.xmin,self.ymin,xScale/cellSize,yScale/cellSize)
+                if len(bucketed) <= parametricPulseGraph.DECIMATED_SEGMENTS or cellSize > max(width,height):
+                    break
+                cellSize *= 2
+            decimated[cat] = bucketed
+        return decimated
+    
+    @staticmethod
+    def bucketSegments(vlist, xmin, ymin, xScale, yScale):
+        '''
+        One segment for each combination of start cell, end cell and DECIMATED_TIMES-th of the time range among
+        vlist's segments, spanning all of their times; cells are 1/xScale by 1/yScale in data units
+        '''
+        cells = numpy.floor(numpy.column_stack(((vlist[:,0]-xmin)*xScale,(vlist[:,1]-ymin)*yScale,
+                                                (vlist[:,3]-xmin)*xScale,(vlist[:,4]-ymin)*yScale))).astype(numpy.int64)
+        starts = vlist[:,2]
+        defined = numpy.isfinite(starts)
+        times = numpy.empty(len(vlist),dtype=numpy.int64)
+        times.fill(parametricPulseGraph.DECIMATED_TIMES)    # undefined times get a bucket of their own
+        if defined.any():
+            low = starts[defined].min()
+            span = starts[defined].max()-low
+            if span > 0:
+                buckets = numpy.floor((starts[defined]-low)*(parametricPulseGraph.DECIMATED_TIMES/span))
+                times[defined] = numpy.minimum(buckets,parametricPulseGraph.DECIMATED_TIMES-1)
+            else:
+                times[defined] = 0
+        
+        # Number the combinations, so that one sort groups them
+        cells -= cells.min(axis=0)
+        keys = times
+        for column in xrange(4):
+            keys = keys*(cells[:,column].max()+1) + cells[:,column]
+        order = numpy.argsort(keys,kind='mergesort')
+        keys = keys[order]
+        firsts = numpy.ones(len(order),dtype=bool)
+        firsts[1:] = keys[1:] != keys[:-1]
+        groups = numpy.flatnonzero(firsts)
+        bucketed = vlist[order[groups]]
+        bucketed[:,2] = numpy.fmin.reduceat(vlist[order,2],groups)
+        bucketed[:,5] = numpy.fmax.reduceat(vlist[order,5],groups)
+        return bucketed
+    
+    @staticmethod
+    def indexTimes(vectors):
+        '''
+        Sorts each class's segments by start time and remembers the longest segment, so that slicedLines can binary
+        search for the segments overlapping the time slice instead of scanning all of them; returns the sorted
+        segments and the index
+        '''
+        sortedVectors = {}
+        timeIndex = {}
+        for cat,vlist in vectors.iteritems():
+            order = numpy.argsort(vlist[:,2],kind='mergesort')    # undefined start times sort to the end
+            vlist = vlist[order]
+            sortedVectors[cat] = vlist
+            with numpy.errstate(invalid='ignore'):
+                durations = vlist[:,5]-vlist[:,2]
+            if len(vlist) == 0 or numpy.isnan(durations).all():
+                longest = 0.0
+            else:
+                longest = numpy.nanmax(durations)
+            timeIndex[cat] = (vlist[:,2],longest)
+        return (sortedVectors,timeIndex)
+    
+    def detailLevel(self):
+        '''
+        The segments and time index to draw with: full resolution only when the tile is shown at FULL_SIZE
+        '''
+        if self.width < parametricPulseGraph.FULL_SIZE or self.height < parametricPulseGraph.FULL_SIZE:
+            return (self.smallVectors,self.smallTimeIndex)
+        return (self.vectors,self.timeIndex)
+    
+    def invalidate(self):
+        '''
+        Throws away the cached static layer and scaled lines; called when the data changes
+        '''
+        self.staticLayer = None
+        self.linesKey = None
+        self.update()
+    
+    def hasVariation(self):
+        return self.vectors != None and (self.xmax != self.xmin or self.ymax != self.ymin)
+    
+    def scalePoints(self, xs, ys):
+        '''
+        Maps data coordinates to tile coordinates (a gene without variation goes down the middle)
+        '''
+        if self.xmax == self.xmin:
+            xs = self.width/2.0
+        else:
+            xs = (xs-self.xmin)*(self.width/(self.xmax-self.xmin))
+        if self.ymax == self.ymin:
+            ys = self.height/2.0
+        else:
+            ys = (ys-self.ymin)*(self.height/(self.ymax-self.ymin))
+        return (xs,ys)
+    
+    def scaledLines(self):
+        '''
+        Each class's segments in tile coordinates, as an (n,4) array of x0,y0,x1,y1 rows; only recomputed on resize
+        '''
+        if self.linesKey != (self.width,self.height):
+            self.lines = {}
+            vectors,timeIndex = self.detailLevel()
+            if self.swapped:
+                x0,y0,x1,y1 = 1,0,4,3
+            else:
+                x0,y0,x1,y1 = 0,1,3,4
+            for cat,vlist in vectors.iteritems():
+                lines = numpy.empty((len(vlist),4),dtype=numpy.float64)
+                lines[:,0],lines[:,1] = self.scalePoints(vlist[:,x0],vlist[:,y0])
+                lines[:,2],lines[:,3] = self.scalePoints(vlist[:,x1],vlist[:,y1])
+                self.lines[cat] = lines
+            self.linesKey = (self.width,self.height)
+        return self.lines
+    
+    def sliceRange(self, cat):
+        '''
+        The current slice's start and end times, and the range of cat's (sorted) segments that might overlap it
+        '''
+        # Only segments starting in (sliceStart-longest,sliceEnd) can overlap the slice
+        sliceStart = parametricPulseGraph.CURRENT_TIME-parametricPulseGraph.SLICE_DURATION
+        sliceEnd = parametricPulseGraph.CURRENT_TIME+parametricPulseGraph.SLICE_DURATION
+        starts,longest = self.detailLevel()[1][cat]
+        first = starts.searchsorted(sliceStart-longest,side='right')
+        last = starts.searchsorted(sliceEnd,side='left')
+        return (sliceStart,sliceEnd,first,last)
+    
+    def hasSlice(self):
+        '''
+        Whether any of the segments drawn by this tile overlap the current time slice
+        '''
+        if not self.hasVariation():
+            return False
+        vectors = self.detailLevel()[0]
+        for cat in parametricPulseGraph.COLOR_MAP.iterkeys():
+            if not vectors.has_key(cat):
+                continue
+            sliceStart,sliceEnd,first,last = self.sliceRange(cat)
+            vlist = vectors[cat][first:last]
+            with numpy.errstate(invalid='ignore'):
+                if (numpy.minimum(sliceEnd,vlist[:,5]) > numpy.maximum(sliceStart,vlist[:,2])).any():
+                    return True
+        return False
+    
+    def updateSlice(self):
+        '''
+        Repaints the tile (but not its labels) if the time slice it shows has changed: if it drew part of the slice
+        last time, or has part of the slice to draw now
+        '''
+        if self.slicePainted or self.hasSlice():
+            pensize = parametricPulseGraph.BORDER_WIDTH/2
+            self.update(QRectF(-pensize,-pensize,self.width+2*pensize,self.height+2*pensize))
+            return True
+        return False
+    
+    def slicedLines(self, cat):
+        '''
+        The parts of cat's segments that fall within the current time slice, in tile coordinates
+        '''
+        sliceStart,sliceEnd,first,last = self.sliceRange(cat)
+        vlist = self.detailLevel()[0][cat][first:last]
+        lines = self.scaledLines()[cat][first:last]
+        t0 = vlist[:,2]
+        t1 = vlist[:,5]
+        with numpy.errstate(invalid='ignore'):
+            startTime = numpy.maximum(sliceStart,t0)
+            endTime = numpy.minimum(sliceEnd,t1)
+            inside = endTime > startTime    # false for undefined times, too
+        t0 = t0[inside]
+        span = t1[inside] - t0
+        startTime = (startTime[inside]-t0)/span
+        endTime = (endTime[inside]-t0)/span
+        lines = lines[inside]
+        dx = lines[:,2]-lines[:,0]
+        dy = lines[:,3]-lines[:,1]
+        sliced = numpy.empty((len(lines),4),dtype=numpy.float64)
+        sliced[:,0] = lines[:,0] + dx*startTime
+        sliced[:,1] = lines[:,1] + dy*startTime
+        sliced[:,2] = lines[:,0] + dx*endTime
+        sliced[:,3] = lines[:,1] + dy*endTime
+        return sliced
+    
+    @staticmethod
+    def getPen(color, thickness):
+        key = (QColor(color).rgba(),thickness)
+        if not parametricPulseGraph.PEN_CACHE.has_key(key):
+            parametricPulseGraph.PEN_CACHE[key] = QPen(color,thickness)
+        return parametricPulseGraph.PEN_CACHE[key]
+    
+    @staticmethod
+    def toQLines(lines):
+        return [QLineF(*l) for l in lines.tolist()]
+    
+    def renderStaticLayer(self, hints):
+        '''
+        Draws the static layer into a pixmap with the given render hints, so that frames only need to draw the time
+        slice on top
+        '''
+        pensize = parametricPulseGraph.BORDER_WIDTH/2
+        self.staticLayer = QPixmap(int(math.ceil(self.width+2*pensize)),int(math.ceil(self.height+2*pensize)))
+        self.staticLayer.fill(Qt.transparent)
+        self.staticKey = (self.width,self.height,parametricPulseGraph.COLOR_VERSION,int(hints))
+        
+        painter = QPainter(self.staticLayer)
+        painter.setRenderHints(hints)
+        painter.translate(pensize,pensize)
+        self.drawStaticLayer(painter)
+        painter.end()
+    
+    def drawStaticLayer(self, painter):
+        '''
+        Draws everything that doesn't move with the animation (background, border, full trajectories and axis text)
+        '''
+        normalRect = QRectF(0,0,self.width,self.height)
+        rotatedRect = QRectF(0,-self.height,self.width,self.height)
         
         painter.setPen(parametricPulseGraph.BORDER)
         painter.setOpacity(parametricPulseGraph.BACKGROUND_OPACITY)
         painter.drawRect(normalRect)
         painter.fillRect(normalRect,parametricPulseGraph.BACKGROUND)
-        if self.vectors != None and (self.xmax != self.xmin or self.ymax != self.ymin):
-            # Draw vectors
+        if self.hasVariation():
+            # Draw vectors (unless OpenGL is doing it)
+            painter.setOpacity(parametricPulseGraph.UNSLICED_OPACITY)
+            lines = self.scaledLines()
             for cat,color in parametricPulseGraph.COLOR_MAP.iteritems():
-                if not self.vectors.has_key(cat):
+                if parametricPulseGraph.USE_OPENGL or not lines.has_key(cat) or len(lines[cat]) == 0:
                     continue
-                if self.xmax == self.xmin:
-                    xScale = None
-                else:
-                    xScale = self.width / (self.xmax-self.xmin)
-                if self.ymax == self.ymin:
-                    yScale = None
-                else:
-                    yScale = self.height / (self.ymax-self.ymin)
-                for x0,y0,t0,x1,y1,t1 in self.vectors[cat]:
-                    if xScale == None:
-                        x0 = self.width/2
-                        x1 = self.width/2
-                    else:
-                        x0 = (x0-self.xmin)*xScale
-                        x1 = (x1-self.xmin)*xScale
-                    if yScale == None:
-                        y0 = self.height/2
-                        y1 = self.height/2
-                    else:
-                        y0 = (y0-self.ymin)*yScale
-                        y1 = (y1-self.ymin)*yScale
-                    
-                    painter.setOpacity(parametricPulseGraph.UNSLICED_OPACITY)
-                    painter.setPen(QPen(color,parametricPulseGraph.UNSLICED_THICKNESS))
-                    painter.drawLine(x0,y0,x1,y1)
-                    
-                    if t0 == None or t1 == None:
-                        return
-                    
-                    startTime = max(parametricPulseGraph.CURRENT_TIME-parametricPulseGraph.SLICE_DURATION,t0)
-                    endTime = min(parametricPulseGraph.CURRENT_TIME+parametricPulseGraph.SLICE_DURATION,t1)
-                    
-                    if not endTime <= startTime:
-                        startTime = (startTime-t0)/(t1-t0)
-                        endTime = (endTime-t0)/(t1-t0)
-                        
-                        xstart = (x1-x0)*startTime
-                        xend = (x1-x0)*endTime
-                        ystart = (y1-y0)*startTime
-                        yend = (y1-y0)*endTime
-                        painter.setOpacity(parametricPulseGraph.SLICED_OPACITY)
-                        painter.setPen(QPen(color,parametricPulseGraph.SLICED_THICKNESS))
-                        painter.drawLine(x0+xstart,y0+ystart,x0+xend,y0+yend)
-                
+                painter.setPen(parametricPulseGraph.getPen(color,parametricPulseGraph.UNSLICED_THICKNESS))
+                painter.drawLines(parametricPulseGraph.toQLines(lines[cat]))
+            
             # Draw labels
             if min(self.width,self.height) >= parametricPulseGraph.LABEL_THRESHOLD:
                 painter.setFont(parametricPulseGraph.TEXT_FONT)
@@ -177,16 +487,104 @@ class parametricPulseGraph(QGraphicsItem):
             else:
                 painter.drawText(normalRect,Qt.AlignHCenter | Qt.AlignVCenter, "No Variation")
     
+    def paint(self, painter, option, widget=None):
+        start = time.time()
+        self.paintTile(painter)
+        parametricPulseGraph.PAINT_COUNT += 1
+        parametricPulseGraph.PAINT_TIME += time.time()-start
+    
+    def paintTile(self, painter):
+        if self.isTop or self.isLeft or self.isRight or self.isBottom:
+            painter.setFont(parametricPulseGraph.LABEL_FONT)
+            painter.setPen(parametricPulseGraph.LABEL_PEN)
+            painter.setOpacity(parametricPulseGraph.LABEL_OPACITY)
+            
+            if self.isTop:
+                labelRect = QRectF(-self.height,-self.width,self.height-parametricPulseGraph.LABEL_PADDING,self.width)
+                painter.rotate(90)
+                painter.drawText(labelRect, Qt.AlignRight | Qt.AlignVCenter, self.xAttribute)
+                painter.rotate(-90)
+            if self.isBottom:
+                labelRect = QRectF(self.height+parametricPulseGraph.LABEL_PADDING,-self.width,self.height,self.width)
+                painter.rotate(90)
+                painter.drawText(labelRect, Qt.AlignLeft | Qt.AlignVCenter, self.xAttribute)
+                painter.rotate(-90)
+            if self.isLeft:
+                labelRect = QRectF(-self.width,0,self.width-parametricPulseGraph.LABEL_PADDING,self.height)
+                painter.drawText(labelRect, Qt.AlignRight | Qt.AlignVCenter, self.yAttribute)
+            if self.isRight:
+                labelRect = QRectF(self.width+parametricPulseGraph.LABEL_PADDING,0,self.width,self.height)
+                painter.drawText(labelRect, Qt.AlignLeft | Qt.AlignVCenter, self.yAttribute)
+        
+        painter.setOpacity(1.0)
+        if painter.transform().type() > QTransform.TxTranslate:
+            # A scaled or rotated painter (e.g. batchRender's --scale) would stretch the pixmap, so draw it directly
+            painter.save()
+            self.drawStaticLayer(painter)
+            painter.restore()
+        else:
+            hints = painter.renderHints()
+            if self.staticLayer == None or self.staticKey != (self.width,self.height,parametricPulseGraph.COLOR_VERSION,int(hints)):
+                self.renderStaticLayer(hints)
+            pensize = parametricPulseGraph.BORDER_WIDTH/2
+            painter.drawPixmap(-pensize,-pensize,self.staticLayer)
+        
+        self.slicePainted = False
+        if not self.hasVariation():
+            return
+        if parametricPulseGraph.USE_OPENGL:
+            self.paintSegmentsGL(painter)
+            return
+        # Draw the current time slice
+        painter.setOpacity(parametricPulseGraph.SLICED_OPACITY)
+        for cat,color in parametricPulseGraph.COLOR_MAP.iteritems():
+            if not self.vectors.has_key(cat):
+                continue
+            sliced = self.slicedLines(cat)
+            if len(sliced) > 0:
+                painter.setPen(parametricPulseGraph.getPen(color,parametricPulseGraph.SLICED_THICKNESS))
+                painter.drawLines(parametricPulseGraph.toQLines(sliced))
+                self.slicePainted = True
+    
+    def paintSegmentsGL(self, painter):
+        '''
+        Draws the full trajectories and the time slice from vertex buffers, leaving the slicing to the shaders
+        '''
+        if self.glBuffers == None:
+            self.glBuffers = glSegments.segmentBuffers()
+        vectors = self.detailLevel()[0]
+        self.glBuffers.upload(self.scaledLines(),vectors)
+        colors = [(cat,QColor(color)) for cat,color in parametricPulseGraph.COLOR_MAP.iteritems() if vectors.has_key(cat)]
+        passes = [(False,parametricPulseGraph.UNSLICED_THICKNESS,parametricPulseGraph.UNSLICED_OPACITY,colors),
+                  (True,parametricPulseGraph.SLICED_THICKNESS,parametricPulseGraph.SLICED_OPACITY,colors)]
+        self.glBuffers.draw(painter,passes,parametricPulseGraph.CURRENT_TIME-parametricPulseGraph.SLICE_DURATION,
+                            parametricPulseGraph.CURRENT_TIME+parametricPulseGraph.SLICE_DURATION)
+        self.slicePainted = self.hasSlice()
+    
     def boundingRect(self):
+        # Includes the edge labels, so that updating a tile repaints them too
         pensize = parametricPulseGraph.BORDER_WIDTH/2
-        return QRectF(-pensize,-pensize,self.width+pensize,self.height+pensize)
-        
+        left = self.width if self.isLeft else pensize
+        top = self.height if self.isTop else pensize
+        right = self.width+parametricPulseGraph.LABEL_PADDING if self.isRight else pensize
+        bottom = self.height+parametricPulseGraph.LABEL_PADDING if self.isBottom else pensize
+        return QRectF(-left,-top,self.width+left+right,self.height+top+bottom)
+    
+    def shape(self):
+        # Just the tile and its border, so that clicking an edge label doesn't select the tile
+        pensize = parametricPulseGraph.BORDER_WIDTH/2
+        path = QPainterPath()
+        path.addRect(QRectF(-pensize,-pensize,self.width+2*pensize,self.height+2*pensize))
+        return path
+    
     def mousePressEvent(self, event):
         self.parent.setTarget(self.xAttribute,self.yAttribute)
     
     @staticmethod
-    def nextFrame():
-        parametricPulseGraph.CURRENT_TIME += parametricPulseGraph.CURRENT_SPEED
+    def nextFrame(step=None):
+        if step == None:
+            step = parametricPulseGraph.CURRENT_SPEED
+        parametricPulseGraph.CURRENT_TIME += step
         if parametricPulseGraph.CURRENT_TIME - parametricPulseGraph.SLICE_DURATION > parametricPulseGraph.TIME_END:
             parametricPulseGraph.CURRENT_TIME = parametricPulseGraph.TIME_START - parametricPulseGraph.SLICE_DURATION
     @staticmethod
@@ -200,42 +598,83 @@ class parametricPulseGraph(QGraphicsItem):
         parametricPulseGraph.MAX_SPEED = math.ceil((parametricPulseGraph.TIME_END-parametricPulseGraph.TIME_START)*parametricPulseGraph.SPEED_LIMIT)
         parametricPulseGraph.CURRENT_SPEED = math.ceil(parametricPulseGraph.MAX_SPEED*0.25)  # everything is moved forward this many seconds every frame (THAT speed is defined by Viz.FRAME_DURATION)
 
+def mergeVectorsBatch(sources, genes, pairs=None):
+    '''
+    getVectorsBatch across several data sources, with each pair's classes from all of them
+    '''
+    batch = {}
+    for s in sources:
+        for pair,vectors in s.getVectorsBatch(genes,pairs).iteritems():
+            batch.setdefault(pair,{}).update(vectors)
+    return batch
+
+def mergeBounds(sources, genes):
+    '''
+    {gene:(low,high)} across several data sources, for the genes any of them have values for
+    '''
+    bounds = {}
+    for s in sources:
+        for g,(low,high) in s.geneBounds(genes).iteritems():
+            if bounds.has_key(g):
+                bounds[g] = (min(low,bounds[g][0]),max(high,bounds[g][1]))
+            else:
+                bounds[g] = (low,high)
+    return bounds
+
+def pairBounds(bounds, x, y):
+    '''
+    The (xmin,xmax,ymin,ymax) a tile gets from mergeBounds' results, or None if either gene has no values
+    '''
+    if bounds.has_key(x) and bounds.has_key(y):
+        return bounds[x] + bounds[y]
+    return None
+
 class multiViewPanel:
+    MAX_TILES = 900 # built tiles to keep around; beyond this, the ones that have been off screen longest are thrown away
+    
     def __init__(self, view, controller):
+        '''
+        view is the QGraphicsView to show the scene in; without one (e.g. when rendering offscreen), every tile
+        counts as visible
+        '''
         self.view = view
         self.controller = controller
         self.scene = QGraphicsScene()
-        self.view.setScene(self.scene)
+        if self.view != None:
+            self.view.setScene(self.scene)
+            for scrollBar in (self.view.horizontalScrollBar(),self.view.verticalScrollBar()):
+                scrollBar.valueChanged.connect(self.updateVisible)
+                scrollBar.rangeChanged.connect(self.updateVisible)
         
-        self.variables = {}
+        self.variables = set()
         self.variableOrder = []
+        self.indices = {}
+        self.columnStarts = []
+        self.rowStarts = []
+        self.tiles = OrderedDict()  # (x,y):parametricPulseGraph, only for tiles that have been on screen; least recently seen first
+        self.tilesByVariable = {}   # var:set of the (x,y) pairs in self.tiles that involve it
+        self.visible = []
+        self.viewRect = QRectF()
         self.currentX = None
         self.currentY = None
+        
+        # The layout the built tiles are currently placed in
+        self.columnOf = {}
+        self.rowOf = {}
+        self.layoutTarget = (None,None)
+        self.layoutEnds = (None,None)
     
     def addVariable(self, var):
-        if not var in self.variables.iterkeys():
-            p = parametricPulseGraph(self,var,var,self.controller.getVectors(var,var))
-            self.scene.addItem(p)
-            varGraphs = {var:p}    # stick in a placeholder for the diagonal
-            for v,graphs in self.variables.iteritems():
-                x = parametricPulseGraph(self,var,v,self.controller.getVectors(var,v))
-                y = parametricPulseGraph(self,v,var,self.controller.getVectors(v,var))
-                self.scene.addItem(x)
-                self.scene.addItem(y)
-                varGraphs[v] = x
-                graphs[var] = y
-            self.variables[var] = varGraphs
+        if not var in self.variables:
+            self.variables.add(var)
             self.variableOrder.append(var)
         self.updateView()
     
     def removeVariable(self, var):
         self.variableOrder.remove(var)
-        for v in self.variables[var].itervalues():
-            self.scene.removeItem(v)
-        del self.variables[var]
-        for v in self.variableOrder:
-            self.scene.removeItem(self.variables[v][var])
-            del self.variables[v][var]
+        self.variables.remove(var)
+        for pair in list(self.tilesByVariable.get(var,[])):
+            self.removeTile(pair)
         if self.currentX == var or self.currentY == var:
             self.noTarget()
         else:
@@ -254,47 +693,240 @@ class multiViewPanel:
             self.currentY = y
             self.updateView()
     
-    def updateView(self):
+    def layoutAxis(self, current):
+        '''
+        Where each column (or row) starts, and the total length; the current variable's column (or row) is widened
+        to make room for the full size tile
+        '''
+        starts = []
+        position = 0
+        for var in self.variableOrder:
+            starts.append(position)
+            if var == current:
+                position += parametricPulseGraph.FULL_SIZE
+            else:
+                position += parametricPulseGraph.SMALL_SIZE
+        return (starts,position)
+    
+    def placeTile(self, tile):
+        '''
+        Moves a tile to where the current layout puts it; it is only repainted if its size or edges changed
+        '''
+        i = self.indices[tile.xAttribute]
+        j = self.indices[tile.yAttribute]
+        edges = (i == 0,j == 0,i == len(self.variableOrder)-1,j == len(self.variableOrder)-1)
+        
         padding = (parametricPulseGraph.FULL_SIZE-parametricPulseGraph.SMALL_SIZE)/2
-        xPos = 0
-        for i,x in enumerate(self.variableOrder):
-            if x == self.currentX:
-                xPos += padding
-            
-            yPos = 0
-            for j,y in enumerate(self.variableOrder):
-                self.variables[x][y].isLeft = i == 0
-                self.variables[x][y].isTop = j == 0
-                self.variables[x][y].isRight = i == len(self.variableOrder)-1
-                self.variables[x][y].isBottom = j == len(self.variableOrder)-1
-                
-                if x == self.currentX and y == self.currentY:
-                    self.variables[x][y].setPos(xPos-padding,yPos)
-                    self.variables[x][y].width = parametricPulseGraph.FULL_SIZE
-                    self.variables[x][y].height = parametricPulseGraph.FULL_SIZE
-                    yPos += parametricPulseGraph.FULL_SIZE
-                else:
-                    if y == self.currentY:
-                        yPos += padding
-                    self.variables[x][y].setPos(xPos,yPos)
-                    self.variables[x][y].width = parametricPulseGraph.SMALL_SIZE
-                    self.variables[x][y].height = parametricPulseGraph.SMALL_SIZE
-                    yPos += parametricPulseGraph.SMALL_SIZE
-                    if y == self.currentY:
-                        yPos += padding
-            
-            xPos += parametricPulseGraph.SMALL_SIZE
-            if x == self.currentX:
-                xPos += padding
-        self.scene.update()
+        if tile.xAttribute == self.currentX and tile.yAttribute == self.currentY:
+            size = parametricPulseGraph.FULL_SIZE
+            tile.setPos(self.columnStarts[i],self.rowStarts[j])
+        else:
+            size = parametricPulseGraph.SMALL_SIZE
+            tile.setPos(self.columnStarts[i] + (padding if tile.xAttribute == self.currentX else 0),
+                        self.rowStarts[j] + (padding if tile.yAttribute == self.currentY else 0))
+        
+        if size != tile.width or edges != (tile.isLeft,tile.isTop,tile.isRight,tile.isBottom):
+            tile.prepareGeometryChange()
+            tile.isLeft,tile.isTop,tile.isRight,tile.isBottom = edges
+            tile.width = size
+            tile.height = size
+            tile.update()
+    
+    def updateView(self):
+        '''
+        Recomputes the layout, then only places the built tiles whose row or column moved, changed size or gained
+        or lost an edge
+        '''
+        oldColumns = self.columnOf
+        oldRows = self.rowOf
+        oldTarget = self.layoutTarget
+        oldEnds = self.layoutEnds
+        
+        self.indices = dict((var,i) for i,var in enumerate(self.variableOrder))
+        self.columnStarts,width = self.layoutAxis(self.currentX)
+        self.rowStarts,height = self.layoutAxis(self.currentY)
+        self.columnOf = dict(zip(self.variableOrder,self.columnStarts))
+        self.rowOf = dict(zip(self.variableOrder,self.rowStarts))
+        self.layoutTarget = (self.currentX,self.currentY)
+        if len(self.variableOrder) > 0:
+            self.layoutEnds = (self.variableOrder[0],self.variableOrder[-1])
+        else:
+            self.layoutEnds = (None,None)
+        # Leave room around the matrix for the edge labels
+        margin = parametricPulseGraph.SMALL_SIZE+parametricPulseGraph.LABEL_PADDING
+        self.scene.setSceneRect(-margin,-margin,width+2*margin,height+2*margin)
+        
+        special = set(oldTarget+self.layoutTarget+oldEnds+self.layoutEnds)
+        changed = set()
+        for var,start in self.columnOf.iteritems():
+            if var in special or oldColumns.get(var) != start:
+                changed.update(pair for pair in self.tilesByVariable.get(var,[]) if pair[0] == var)
+        for var,start in self.rowOf.iteritems():
+            if var in special or oldRows.get(var) != start:
+                changed.update(pair for pair in self.tilesByVariable.get(var,[]) if pair[1] == var)
+        for pair in changed:
+            self.placeTile(self.tiles[pair])
+        self.updateVisible()
+    
+    def updateSlices(self):
+        '''
+        Called when the current time changes; only the visible tiles whose slice changed get repainted. Returns
+        whether any of them are actually inside the viewport (and so will be painted).
+        '''
+        updated = False
+        for pair in self.visible:
+            tile = self.tiles[pair]
+            if tile.updateSlice() and tile.sceneBoundingRect().intersects(self.viewRect):
+                updated = True
+        return updated
+    
+    def addTile(self, tile):
+        self.placeTile(tile)
+        self.scene.addItem(tile)
+        pair = (tile.xAttribute,tile.yAttribute)
+        self.tiles[pair] = tile
+        self.tilesByVariable.setdefault(pair[0],set()).add(pair)
+        self.tilesByVariable.setdefault(pair[1],set()).add(pair)
+    
+    def removeTile(self, pair):
+        tile = self.tiles.pop(pair)
+        self.scene.removeItem(tile)
+        if tile.glBuffers != None:
+            tile.glBuffers.release()
+            tile.glBuffers = None
+        for var in pair:
+            if self.tilesByVariable.has_key(var):
+                self.tilesByVariable[var].discard(pair)
+                if len(self.tilesByVariable[var]) == 0:
+                    del self.tilesByVariable[var]
+    
+    def addSources(self, sources):
+        '''
+        Appends the data from newly loaded sources to the tiles that are already built, only fetching vectors from
+        the new sources and only for tiles whose genes they have; tiles built later get everything from the
+        controller anyway
+        '''
+        known = set()
+        for s in sources:
+            known.update(s.geneList())
+        affected = [(x,y) for x,y in self.tiles.iterkeys() if x in known or y in known]
+        if len(affected) == 0:
+            return
+        needed = set(x for x,y in affected) | set(y for x,y in affected)
+        genes = [var for var in self.variableOrder if var in needed]
+        bounds = self.controller.getBounds(genes)
+        
+        fetch = []
+        fetched = set()
+        for x,y in affected:
+            if x in known and y in known and not (y,x) in fetched:
+                fetch.append((x,y))
+                fetched.add((x,y))
+        batch = mergeVectorsBatch(sources,genes,fetch) if len(fetch) > 0 else {}
+        for (x,y),vectors in batch.iteritems():
+            if self.tiles[(x,y)].addVectors(vectors,pairBounds(bounds,x,y)) and x != y and self.tiles.has_key((y,x)):
+                partner = self.tiles[(y,x)]
+                partner.shareTransposed(self.tiles[(x,y)])
+                partner.invalidate()
+        
+        # A gene's range can grow even where the new sources add no segments, and the axes of its whole row and
+        # column move with it
+        for x,y in affected:
+            self.tiles[(x,y)].setBounds(pairBounds(bounds,x,y))
+    
+    def rebuildTiles(self):
+        '''
+        Throws away every built tile, e.g. when all of the data has changed; the visible ones are fetched again
+        '''
+        for pair in list(self.tiles.iterkeys()):
+            self.removeTile(pair)
+        self.updateVisible()
+    
+    @staticmethod
+    def visibleRange(starts, low, high):
+        return xrange(max(0,bisect.bisect_right(starts,low)-1),bisect.bisect_left(starts,high))
+    
+    def updateVisible(self, *args):
+        '''
+        Builds the tiles that are (or are about to be) on screen, fetching all of their vectors in one batch, and
+        throws away the tiles that have been off screen the longest
+        '''
+        if len(self.variableOrder) == 0:
+            self.visible = []
+            return
+        margin = parametricPulseGraph.SMALL_SIZE
+        if self.view == None:
+            self.viewRect = self.scene.sceneRect()
+        else:
+            self.viewRect = self.view.mapToScene(self.view.viewport().rect()).boundingRect()
+        visibleRect = self.viewRect.adjusted(-margin,-margin,margin,margin)
+        columns = multiViewPanel.visibleRange(self.columnStarts,visibleRect.left(),visibleRect.right())
+        rows = multiViewPanel.visibleRange(self.rowStarts,visibleRect.top(),visibleRect.bottom())
+        visible = [(self.variableOrder[i],self.variableOrder[j]) for i in columns for j in rows]
+        
+        missing = [pair for pair in visible if not self.tiles.has_key(pair)]
+        if len(missing) > 0:
+            # Only fetch one of (x,y) and (y,x); the other tile is its transpose
+            fetch = []
+            for x,y in missing:
+                if not self.tiles.has_key((y,x)) and not (y,x) in fetch:
+                    fetch.append((x,y))
+            needed = set(x for x,y in fetch) | set(y for x,y in fetch)
+            genes = [var for var in self.variableOrder if var in needed]
+            batch = self.controller.getVectorsBatch(genes,fetch) if len(fetch) > 0 else {}
+            bounds = self.controller.getBounds(genes) if len(fetch) > 0 else {}
+            for x,y in fetch:
+                self.addTile(parametricPulseGraph(self,x,y,batch.get((x,y)),pairBounds(bounds,x,y)))
+            for x,y in missing:
+                if not self.tiles.has_key((x,y)):
+                    self.addTile(self.tiles[(y,x)].transposed())
+        
+        for pair in visible:
+            self.tiles[pair] = self.tiles.pop(pair)
+        self.visible = visible
+        while len(self.tiles) > max(multiViewPanel.MAX_TILES,len(visible)):
+            self.removeTile(next(self.tiles.iterkeys()))
     
+class progressReporter:
+    '''
+    Progress callback that a loading process can be handed: stores the fraction done under key in a Manager dict,
+    where the main process can poll it
+    '''
+    def __init__(self, fractions, key):
+        self.fractions = fractions
+        self.key = key
+    
+    def __call__(self, fraction):
+        self.fractions[self.key] = fraction
+
 class Viz:
     FRAME_DURATION = 1000/30 # 30 FPS
+    STATS_DURATION = 1000   # ms between updates of the frame rate readout
+    MAX_FRAME_WAIT = 250    # ms to hold back the next frame while waiting for the last one to be painted
     DEFAULT_COLOR = Qt.lightGray
+    SEARCH_LIMIT = 1000 # most matches to offer while typing a gene name
+    LAZY_SIZE = 2**28   # SOFT files bigger than this (on disk) are memory-mapped instead of read into RAM
+    LOAD_POLL_DURATION = 100 # ms between checks on the loading processes
+    PROGRESS_STEPS = 100    # progress bar steps per file being loaded
+    TIME_GRID_POINTS = None  # if set, every source is resampled onto this many shared timepoints
+    CACHE_BYTES = 2**28 # memory to spend keeping fetched vectors around for when their tiles are rebuilt
+    CACHE_ENTRY_BYTES = 256 # roughly what each cached pair costs beyond its arrays
     def __init__(self):
         self.loadedPaths = set()
         self.dataSources = []
-        self.genes = set()
+        self.geneSearch = GeneSearch()
+        self.classNames = []    # the class table's rows, in order
+        self.vectorCache = OrderedDict()    # (x,y,sourceVersion):vectors, least recently used first
+        self.cacheBytes = 0
+        self.sourceVersion = 0  # bumped whenever sources are added, so cached vectors from fewer sources never match
+        
+        self.loadPool = None
+        self.loadManager = None
+        self.loadFractions = None
+        self.loadJobs = []
+        self.loadResults = {}
+        if Viz.TIME_GRID_POINTS != None:
+            self.updateTimeGrid()
         
         self.loader = QUiLoader()
         infile = QFile("expressionTopology.ui")
@@ -305,14 +937,26 @@ class Viz:
         self.updateTimeSliders()
         
         # Main view
+        if parametricPulseGraph.USE_OPENGL:
+            self.window.graphicsView.setViewport(glSegments.makeViewport())
+            self.window.graphicsView.setViewportUpdateMode(QGraphicsView.FullViewportUpdate)    # OpenGL viewports can't do partial updates
         self.multiPanel = multiViewPanel(self.window.graphicsView,self)
         
         # Events
         self.window.categoryTable.cellClicked.connect(self.changeColor)
         self.window.loadButton.clicked.connect(self.loadData)
+        self.window.ensembleButton.clicked.connect(self.loadEnsemble)
         self.window.quitButton.clicked.connect(self.window.close)
         self.window.addButton.clicked.connect(self.addGene)
         self.window.geneBox.editTextChanged.connect(self.editGene)
+        
+        # The gene box only ever sees a lazy model; completions come from the search index
+        self.geneModel = GeneListModel(self.window)
+        self.window.geneBox.setModel(self.geneModel)
+        self.completionModel = GeneListModel(self.window)
+        self.geneCompleter = QCompleter(self.completionModel,self.window)
+        self.geneCompleter.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.window.geneBox.setCompleter(self.geneCompleter)
         self.window.speedSlider.valueChanged.connect(self.changeSpeed)
         self.window.timeSlider.valueChanged.connect(self.changeTime)
         
@@ -324,6 +968,12 @@ class Viz:
         # Start timer
         
         # Update timer
+        self.lastFrame = time.time()
+        self.framePending = False
+        self.framePaintCount = 0
+        self.frameCount = 0
+        self.skippedFrames = 0
+        self.statsStart = self.lastFrame
         self.timer = QTimer(self.window)
         self.timer.timeout.connect(self.nextFrame)
         self.timer.start(Viz.FRAME_DURATION)
@@ -332,12 +982,13 @@ class Viz:
         if column == 1:
             col = QColorDialog.getColor()
             parametricPulseGraph.COLOR_MAP[self.window.categoryTable.item(row,0).text()] = col
+            parametricPulseGraph.COLOR_VERSION += 1
             self.window.categoryTable.item(row,1).setBackground(col)
             self.multiPanel.scene.update()
     
     def addGene(self):
-        g = self.window.geneBox.currentText()
-        if g in self.genes:
+        g = self.geneSearch.resolve(self.window.geneBox.currentText())
+        if g != None:
             t = self.window.addButton.text()
             if t == 'Add':
                 self.multiPanel.addVariable(g)
@@ -347,9 +998,13 @@ class Viz:
                 self.window.addButton.setText('Add')
     
     def editGene(self):
-        g = self.window.geneBox.currentText()
-        if g in self.genes:
-            if self.multiPanel.variables.has_key(g):
+        text = self.window.geneBox.currentText()
+        self.completionModel.setItems(self.geneSearch.find(text,Viz.SEARCH_LIMIT))
+        if len(text) > 0 and self.window.geneBox.hasFocus():
+            self.geneCompleter.complete()
+        g = self.geneSearch.resolve(text)
+        if g != None:
+            if g in self.multiPanel.variables:
                 self.window.addButton.setText('Remove')
             else:
                 self.window.addButton.setText('Add')
@@ -358,16 +1013,85 @@ class Viz:
             self.window.addButton.setEnabled(False)
     
     def getVectors(self, x, y):
-        vectors = {}
-        for s in self.dataSources:
-            vectors.update(s.getVectors(x,y))
-        return vectors
+        return self.getVectorsBatch([x,y],[(x,y)])[(x,y)]
+    
+    def getVectorsBatch(self, genes, pairs=None):
+        '''
+        Vectors for each pair from all of the data sources; pairs seen recently come from the cache, and only the
+        rest are fetched (in one batch)
+        '''
+        if pairs == None:
+            pairs = [(x,y) for x in genes for y in genes]
+        batch = {}
+        missing = []
+        for pair in pairs:
+            key = pair + (self.sourceVersion,)
+            if self.vectorCache.has_key(key):
+                batch[pair] = self.vectorCache.pop(key)
+                self.vectorCache[key] = batch[pair]
+            else:
+                missing.append(pair)
+        if len(missing) > 0:
+            needed = set(x for x,y in missing) | set(y for x,y in missing)
+            fetched = mergeVectorsBatch(self.dataSources,[g for g in genes if g in needed],missing)
+            for pair in missing:
+                batch[pair] = fetched.get(pair,{})
+                self.cacheVectors(pair,batch[pair])
+        return batch
+    
+    def getBounds(self, genes):
+        return mergeBounds(self.dataSources,genes)
+    
+    def cacheVectors(self, pair, vectors):
+        size = Viz.CACHE_ENTRY_BYTES + sum(vlist.nbytes for vlist in vectors.itervalues())
+        if size > Viz.CACHE_BYTES:
+            return
+        self.vectorCache[pair + (self.sourceVersion,)] = vectors
+        self.cacheBytes += size
+        while self.cacheBytes > Viz.CACHE_BYTES:
+            key,old = self.vectorCache.popitem(last=False)
+            self.cacheBytes -= Viz.CACHE_ENTRY_BYTES + sum(vlist.nbytes for vlist in old.itervalues())
+    
+    def clearVectorCache(self):
+        self.vectorCache = OrderedDict()
+        self.cacheBytes = 0
+        self.sourceVersion += 1
     
     def nextFrame(self):
-        if parametricPulseGraph.CURRENT_SPEED > 0:
-            parametricPulseGraph.nextFrame()
-            self.window.timeSlider.setSliderPosition(parametricPulseGraph.CURRENT_TIME)
-            self.multiPanel.scene.update()
+        now = time.time()
+        if self.framePending and parametricPulseGraph.PAINT_COUNT == self.framePaintCount and now-self.lastFrame < Viz.MAX_FRAME_WAIT/1000.0:
+            # The last frame hasn't been drawn yet; skip this one, and the next step will cover the time it took
+            self.skippedFrames += 1
+        else:
+            if parametricPulseGraph.CURRENT_SPEED > 0:
+                # CURRENT_SPEED is per FRAME_DURATION; scale it by how long this frame actually took
+                step = parametricPulseGraph.CURRENT_SPEED*(now-self.lastFrame)*1000.0/Viz.FRAME_DURATION
+                parametricPulseGraph.nextFrame(min(step,parametricPulseGraph.MAX_SPEED))
+                self.window.timeSlider.blockSignals(True)
+                self.window.timeSlider.setSliderPosition(int(parametricPulseGraph.CURRENT_TIME))
+                self.window.timeSlider.blockSignals(False)
+                self.framePending = self.multiPanel.updateSlices()
+                self.framePaintCount = parametricPulseGraph.PAINT_COUNT
+                self.frameCount += 1
+            self.lastFrame = now
+        
+        if now-self.statsStart >= Viz.STATS_DURATION/1000.0:
+            self.showFrameStats(now)
+    
+    def showFrameStats(self, now):
+        '''
+        Shows the frame rate, paint time per frame and skipped frames since the last readout, then starts counting again
+        '''
+        elapsed = now-self.statsStart
+        if self.frameCount > 0:
+            paintTime = 1000*parametricPulseGraph.PAINT_TIME/self.frameCount
+        else:
+            paintTime = 0.0
+        self.window.frameLabel.setText("%.0f fps, %.1f ms painting, %i skipped" % (self.frameCount/elapsed,paintTime,self.skippedFrames))
+        self.statsStart = now
+        self.frameCount = 0
+        self.skippedFrames = 0
+        parametricPulseGraph.PAINT_TIME = 0.0
     
     def updateTimeSliders(self):
         self.window.timeSlider.setMinimum(parametricPulseGraph.TIME_START)
@@ -386,48 +1110,119 @@ class Viz:
     
     def changeTime(self):
         parametricPulseGraph.CURRENT_TIME = self.window.timeSlider.value()
-        self.multiPanel.scene.update()
+        self.multiPanel.updateSlices()
     
     def loadData(self):
-        fileNames = QFileDialog.getOpenFileNames(caption=u"Open expression data file", filter=u"SOFT (*.soft);;Time Series Data (*.tsd)")[0]  #;;Comma separated value (*.csv);;Column separated data (*.dat)
+        fileNames = QFileDialog.getOpenFileNames(caption=u"Open expression data file", filter=u"SOFT (*.soft *.soft.gz);;Time Series Data (*.tsd)")[0]  #;;Comma separated value (*.csv);;Column separated data (*.dat)
+        fileNames = [f for f in fileNames if not f in self.loadedPaths]
         if len(fileNames) == 0:
             return
         
+        self.startLoading([(f,loadSource,(f,Viz.LAZY_SIZE)) for f in fileNames])
+    
+    def loadEnsemble(self):
+        directory = QFileDialog.getExistingDirectory(caption=u"Open a directory of simulation runs")
+        if len(directory) == 0 or directory in self.loadedPaths:
+            return
+        pattern,ok = QInputDialog.getText(self.window, u"Group runs", u"Regular expression to group runs by their file names\n(leave blank to put all runs in one class):")
+        if not ok:
+            return
+        summary = QMessageBox.question(self.window, u"Summarize runs", u"Show the mean, median and percentiles of the runs in each class instead of every run?", QMessageBox.Yes | QMessageBox.No) == QMessageBox.Yes
+        self.startLoading([(directory,TsdEnsemble,(directory,pattern if len(pattern) > 0 else None,summary))])
+    
+    def startLoading(self, jobs):
+        '''
+        Runs each (path, function, arguments) job in its own worker process; checkLoading picks up the results as
+        they come in. Each function is also passed a progress callback, which records how far along it is.
+        '''
+        self.loadManager = multiprocessing.Manager()
+        self.loadFractions = self.loadManager.dict()
+        self.loadPool = multiprocessing.Pool(min(len(jobs),multiprocessing.cpu_count()))
+        self.loadJobs = [(f,self.loadPool.apply_async(function,args,{'progress':progressReporter(self.loadFractions,f)})) for f,function,args in jobs]
+        self.loadPool.close()
+        self.loadResults = {}
+        
+        self.progressDialog = QProgressDialog("Loading data...", None, 0, len(jobs)*Viz.PROGRESS_STEPS, self.window)
+        self.progressDialog.setMinimumDuration(0)
+        self.progressDialog.setValue(0)
+        self.window.loadButton.setEnabled(False)
+        self.window.ensembleButton.setEnabled(False)
+        
+        self.loadTimer = QTimer(self.window)
+        self.loadTimer.timeout.connect(self.checkLoading)
+        self.loadTimer.start(Viz.LOAD_POLL_DURATION)
+    
+    def checkLoading(self):
+        fractions = dict(self.loadFractions)
+        done = 0.0
+        for f,job in self.loadJobs:
+            if not self.loadResults.has_key(f) and job.ready():
+                try:
+                    self.loadResults[f] = (job.get(),None)
+                except Exception, e:
+                    self.loadResults[f] = (None,str(e))
+            done += 1.0 if self.loadResults.has_key(f) else fractions.get(f,0.0)
+        self.progressDialog.setValue(int(done*Viz.PROGRESS_STEPS))
+        if len(self.loadResults) == len(self.loadJobs):
+            self.loadTimer.stop()
+            self.loadPool.join()
+            self.loadManager.shutdown()
+            self.loadManager = None
+            self.loadFractions = None
+            self.progressDialog.close()
+            self.window.loadButton.setEnabled(True)
+            self.window.ensembleButton.setEnabled(True)
+            self.finishLoading()
+    
+    def updateTimeGrid(self):
+        '''
+        Spreads the shared grid over the full time range of everything loaded
+        '''
+        grid = numpy.linspace(parametricPulseGraph.TIME_START,parametricPulseGraph.TIME_END,Viz.TIME_GRID_POINTS)
+        for s in self.dataSources:
+            s.setGrid(grid)
+    
+    def finishLoading(self):
         errors = []
+        newSources = []
+        oldRange = (parametricPulseGraph.TIME_START,parametricPulseGraph.TIME_END)
         
-        for f in fileNames:
-            if f in self.loadedPaths:
+        for f,job in self.loadJobs:
+            fObj,e = self.loadResults[f]
+            if e != None:
+                errors.append((f,e))
+                continue
+            elif fObj == None:
                 continue
-            ext = os.path.splitext(f)[1].lower()
-            fObj = None
             lastLow = parametricPulseGraph.TIME_START
             lastHigh = parametricPulseGraph.TIME_END
             try:
-                if ext == '.soft':
-                    fObj = SoftFile(f)
-                elif ext == '.tsd':
-                    fObj = TsdFile(f)
-                #elif ext == '.csv':
-                #    self.dataSources.append(CsvFile(f))
-                #elif ext == '.dat':
-                #    self.dataSources.append(DatFile(f))
-                else:
-                    continue
-                self.dataSources.append(fObj)
+                low,high = fObj.timeRange()
+                if low == None or high == None:
+                    raise ValueError('No timepoints found (e.g. no time subsets in a SOFT file)')
+                if Viz.TIME_GRID_POINTS != None:
+                    fObj = ResampledSource(fObj,[])
                 if len(self.loadedPaths) == 0:
-                    low,high = fObj.timeRange()
                     parametricPulseGraph.updateTimes(low,high)
                 else:
-                    low,high = fObj.timeRange()
                     parametricPulseGraph.updateTimes(min(low,parametricPulseGraph.TIME_START),max(high,parametricPulseGraph.TIME_END))
-                self.updateTimeSliders()
-                self.loadedPaths.add(f)
+                self.geneSearch.add(fObj.geneList(),fObj.aliasMap())
             except Exception, e:
                 errors.append((f,str(e)))
-                self.dataSources.remove(fObj)
                 parametricPulseGraph.updateTimes(lastLow,lastHigh)
                 self.updateTimeSliders()
                 continue
+            self.dataSources.append(fObj)
+            newSources.append(fObj)
+            self.updateTimeSliders()
+            self.loadedPaths.add(f)
+        self.loadPool = None
+        self.loadJobs = []
+        self.loadResults = {}
+        if Viz.TIME_GRID_POINTS != None:
+            self.updateTimeGrid()
+        if len(newSources) > 0:
+            self.clearVectorCache()
         
         if len(errors) > 0:
             msgBox = QMessageBox()
@@ -440,36 +1235,42 @@ class Viz:
             msgBox.exec_()
         
         # Update gene box
-        self.genes = set()
-        for s in self.dataSources:
-            self.genes.update(s.geneList())
-        geneList = list(self.genes)
-        self.window.geneBox.clear()
-        self.window.geneBox.addItems(geneList)
-        completer = QCompleter(geneList)
-        completer.setCaseSensitivity(Qt.CaseInsensitive)
-        self.window.geneBox.setCompleter(completer)
-        
-        # Update class table
-        parametricPulseGraph.COLOR_MAP = {}
-        for r in xrange(self.window.categoryTable.rowCount()):
-            parametricPulseGraph.COLOR_MAP[self.window.categoryTable.item(r,0).text()] = self.window.categoryTable.item(r,1).background().color()
-        for s in self.dataSources:
-            for c in s.classList():
-                if not parametricPulseGraph.COLOR_MAP.has_key(c):
-                    parametricPulseGraph.COLOR_MAP[c] = Viz.DEFAULT_COLOR
-        self.window.categoryTable.clear()
-        self.window.categoryTable.setRowCount(len(parametricPulseGraph.COLOR_MAP))
-        self.window.categoryTable.setColumnCount(2)
+        self.geneModel.setItems(self.geneSearch.geneNames)
         
-        for r,(t,c) in enumerate(sorted(parametricPulseGraph.COLOR_MAP.iteritems())):
-            self.window.categoryTable.setItem(r,0,QTableWidgetItem(t))
+        # Add only the new classes to the class table, keeping it sorted
+        newClasses = set()
+        for s in newSources:
+            newClasses.update(c for c in s.classList() if not parametricPulseGraph.COLOR_MAP.has_key(c))
+        self.window.categoryTable.setColumnCount(2)
+        for c in sorted(newClasses):
+            parametricPulseGraph.COLOR_MAP[c] = Viz.DEFAULT_COLOR
+            r = bisect.bisect_left(self.classNames,c)
+            self.classNames.insert(r,c)
+            self.window.categoryTable.insertRow(r)
+            self.window.categoryTable.setItem(r,0,QTableWidgetItem(c))
             cItem = QTableWidgetItem("")
-            cItem.setBackground(c)
+            cItem.setBackground(Viz.DEFAULT_COLOR)
             self.window.categoryTable.setItem(r,1,cItem)
+        
+        # Resampling onto a grid that now spans a wider time range changes all of the data, not just the new data
+        if Viz.TIME_GRID_POINTS != None and oldRange != (parametricPulseGraph.TIME_START,parametricPulseGraph.TIME_END):
+            self.multiPanel.rebuildTiles()
+        else:
+            self.multiPanel.addSources(newSources)
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description='Parametric visualization of gene expression data')
+    parser.add_argument('--grid', type=int, metavar='POINTS', help='resample all data onto this many shared, evenly spaced timepoints')
+    parser.add_argument('--opengl', action='store_true', help='draw the trajectories with OpenGL (needs PyOpenGL)')
+    args,qtArgs = parser.parse_known_args()
+    Viz.TIME_GRID_POINTS = args.grid
+    if args.opengl:
+        if glSegments.AVAILABLE:
+            parametricPulseGraph.USE_OPENGL = True
+        else:
+            print "PyOpenGL or PySide.QtOpenGL isn't available; drawing without OpenGL"
     parametricPulseGraph.updateTimes(0,100)
-    app = QApplication(sys.argv)
+    app = QApplication(sys.argv[:1] + qtArgs)
     window = Viz()
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,107 @@
+'''
+Searching the names of every gene loaded so far (tens of thousands, once a few SOFT files are merged) fast enough to
+keep up with typing, and showing the results without handing Qt all of them at once.
+'''
+import bisect
+from PySide.QtCore import Qt, QAbstractListModel, QModelIndex
+
+class GeneSearch:
+    '''
+    A sorted, case-insensitive index of gene names and their aliases (e.g. probe IDs). Sources are added one at a
+    time as they load; find does prefix matches by binary search, then substring matches, and resolve turns a name
+    or alias into the gene it refers to.
+    '''
+    def __init__(self):
+        self.genes = set()
+        self.aliases = {}   # alias:gene
+        self.keys = []      # lowercase names, sorted, for bisecting
+        self.names = []     # the names themselves, in the same order as keys
+        self.geneNames = [] # just the genes (not aliases), sorted
+    
+    def add(self, genes, aliases=None):
+        '''
+        Adds the genes (and an alias:gene dict) from one more source
+        '''
+        newGenes = set(g for g in genes if g != None and not g in self.genes)
+        newAliases = {}
+        if aliases != None:
+            for a,g in aliases.iteritems():
+                if not self.aliases.has_key(a) and not a in self.genes and not a in newGenes:
+                    newAliases[a] = g
+        if len(newGenes) == 0 and len(newAliases) == 0:
+            return
+        self.genes.update(newGenes)
+        self.aliases.update(newAliases)
+        
+        # Both lists are already sorted, so sort() only has to merge the new names in
+        entries = zip(self.keys,self.names)
+        entries.extend(sorted((n.lower(),n) for n in newGenes.union(newAliases.iterkeys())))
+        entries.sort()
+        self.keys = [k for k,n in entries]
+        self.names = [n for k,n in entries]
+        self.geneNames.extend(sorted(newGenes))
+        self.geneNames.sort()
+    
+    def find(self, text, limit=None):
+        '''
+        Names starting with text, then names containing it elsewhere (case-insensitive), up to limit of them
+        '''
+        text = text.lower()
+        if len(text) == 0:
+            return self.names[:limit]
+        low = bisect.bisect_left(self.keys,text)
+        high = bisect.bisect_left(self.keys,text + u'\uffff')
+        results = self.names[low:high]
+        if limit != None and len(results) >= limit:
+            return results[:limit]
+        for i,k in enumerate(self.keys):
+            if text in k and not (low <= i < high):
+                results.append(self.names[i])
+                if limit != None and len(results) >= limit:
+                    break
+        return results
+    
+    def resolve(self, name):
+        '''
+        The gene that name refers to (itself, or the gene it's an alias of), or None
+        '''
+        if name in self.genes:
+            return name
+        return self.aliases.get(name)
+
+class GeneListModel(QAbstractListModel):
+    '''
+    A list model over a (possibly huge) list of names that only reports FETCH_SIZE more rows each time the view
+    scrolls to the end, so views never lay out the whole list
+    '''
+    FETCH_SIZE = 500
+    
+    def __init__(self, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self.items = []
+        self.shown = 0
+    
+    def setItems(self, items):
+        self.beginResetModel()
+        self.items = items
+        self.shown = min(len(items),GeneListModel.FETCH_SIZE)
+        self.endResetModel()
+    
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.shown
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and index.row() < self.shown and (role == Qt.DisplayRole or role == Qt.EditRole):
+            return self.items[index.row()]
+        return None
+    
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.shown < len(self.items)
+    
+    def fetchMore(self, parent):
+        more = min(len(self.items)-self.shown,GeneListModel.FETCH_SIZE)
+        self.beginInsertRows(QModelIndex(),self.shown,self.shown+more-1)
+        self.shown += more
+        self.endInsertRows()
@@ -0,0 +1,149 @@
+'''
+Optional OpenGL drawing for parametricPulseGraph. Each tile's segments are uploaded once to vertex buffers (with the
+time of every vertex alongside its position), and the time slice is picked out by the fragment shader, so a frame of
+the animation only costs the CPU a few calls per tile, however much data there is. Needs PyOpenGL and
+PySide.QtOpenGL; check AVAILABLE before using anything else here.
+'''
+import numpy
+
+try:
+    from PySide.QtOpenGL import QGLWidget, QGLFormat, QGL
+    from OpenGL import GL
+    from OpenGL.GL import shaders
+    from OpenGL.arrays import vbo
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+VERTEX_SHADER = '''
+#version 120
+attribute vec3 vertex;  // x and y in tile coordinates, then time
+varying float time;
+void main() {
+    time = vertex.z;
+    gl_Position = gl_ModelViewProjectionMatrix * vec4(vertex.xy, 0.0, 1.0);
+}
+'''
+
+FRAGMENT_SHADER = '''
+#version 120
+uniform vec4 color;
+uniform bool sliced;
+uniform float sliceStart;
+uniform float sliceEnd;
+varying float time;
+void main() {
+    if (sliced && !(time >= sliceStart && time <= sliceEnd))
+        discard;
+    gl_FragColor = color;
+}
+'''
+
+PROGRAM = None  # compiled the first time anything is drawn, once there's a context
+RELEASED = []   # buffers of tiles that have been thrown away, deleted the next time something is drawn
+
+def makeViewport():
+    return QGLWidget(QGLFormat(QGL.SampleBuffers))
+
+def getProgram():
+    global PROGRAM
+    if PROGRAM == None:
+        PROGRAM = shaders.compileProgram(shaders.compileShader(VERTEX_SHADER,GL.GL_VERTEX_SHADER),
+                                         shaders.compileShader(FRAGMENT_SHADER,GL.GL_FRAGMENT_SHADER))
+    return PROGRAM
+
+def deleteReleased():
+    '''
+    Frees the released buffers; only call this while the context is current
+    '''
+    while len(RELEASED) > 0:
+        RELEASED.pop().delete()
+
+def painterMatrix(painter):
+    '''
+    The painter's current transform as a column-major OpenGL matrix
+    '''
+    t = painter.combinedTransform()
+    return numpy.array([t.m11(),t.m12(),0,t.m13(),
+                        t.m21(),t.m22(),0,t.m23(),
+                        0,0,1,0,
+                        t.dx(),t.dy(),0,t.m33()],dtype=numpy.float64)
+
+class segmentBuffers:
+    def __init__(self):
+        self.buffers = {}
+        self.lines = None
+    
+    def upload(self, lines, vectors):
+        '''
+        Copies each class's scaled lines (from parametricPulseGraph.scaledLines) and the times of the matching
+        segments into vertex buffers; nothing happens if the lines haven't been recomputed since the last upload
+        '''
+        if lines is self.lines:
+            return
+        for cat,vlist in vectors.iteritems():
+            vertices = numpy.empty((2*len(vlist),3),dtype=numpy.float32)
+            vertices[0::2,0:2] = lines[cat][:,0:2]
+            vertices[0::2,2] = vlist[:,2]
+            vertices[1::2,0:2] = lines[cat][:,2:4]
+            vertices[1::2,2] = vlist[:,5]
+            if self.buffers.has_key(cat):
+                self.buffers[cat].set_array(vertices)
+            else:
+                self.buffers[cat] = vbo.VBO(vertices)
+        self.lines = lines
+    
+    def release(self):
+        '''
+        Hands the buffers over to be deleted (there may be no current context here, so it happens in draw)
+        '''
+        RELEASED.extend(self.buffers.itervalues())
+        self.buffers = {}
+        self.lines = None
+    
+    def draw(self, painter, passes, sliceStart, sliceEnd):
+        '''
+        Draws the uploaded segments; passes is a list of (sliced, thickness, opacity, [(class, color)]) tuples,
+        where sliced passes only draw the parts of segments between sliceStart and sliceEnd
+        '''
+        painter.beginNativePainting()
+        try:
+            deleteReleased()
+            device = painter.device()
+            GL.glMatrixMode(GL.GL_PROJECTION)
+            GL.glPushMatrix()
+            GL.glLoadIdentity()
+            GL.glOrtho(0,device.width(),device.height(),0,-1,1)
+            GL.glMatrixMode(GL.GL_MODELVIEW)
+            GL.glPushMatrix()
+            GL.glLoadMatrixd(painterMatrix(painter))
+            GL.glEnable(GL.GL_BLEND)
+            GL.glBlendFunc(GL.GL_SRC_ALPHA,GL.GL_ONE_MINUS_SRC_ALPHA)
+            
+            program = getProgram()
+            GL.glUseProgram(program)
+            vertexLocation = GL.glGetAttribLocation(program,'vertex')
+            GL.glUniform1f(GL.glGetUniformLocation(program,'sliceStart'),sliceStart)
+            GL.glUniform1f(GL.glGetUniformLocation(program,'sliceEnd'),sliceEnd)
+            GL.glEnableVertexAttribArray(vertexLocation)
+            for sliced,thickness,opacity,colors in passes:
+                GL.glUniform1i(GL.glGetUniformLocation(program,'sliced'),int(sliced))
+                GL.glLineWidth(thickness)
+                for cat,color in colors:
+                    if not self.buffers.has_key(cat) or len(self.buffers[cat].data) == 0:
+                        continue
+                    GL.glUniform4f(GL.glGetUniformLocation(program,'color'),color.redF(),color.greenF(),color.blueF(),opacity)
+                    segments = self.buffers[cat]
+                    segments.bind()
+                    GL.glVertexAttribPointer(vertexLocation,3,GL.GL_FLOAT,False,0,segments)
+                    GL.glDrawArrays(GL.GL_LINES,0,len(segments.data))
+                    segments.unbind()
+            GL.glDisableVertexAttribArray(vertexLocation)
+            GL.glUseProgram(0)
+            
+            GL.glMatrixMode(GL.GL_MODELVIEW)
+            GL.glPopMatrix()
+            GL.glMatrixMode(GL.GL_PROJECTION)
+            GL.glPopMatrix()
+        finally:
+            painter.endNativePainting()
@@ -39,7 +39,7 @@ if sys.platform == 'win32':
     excludes = ['_gtkagg', '_tkagg', 'bsddb', 'curses', 'email', 'pywin.debugger',
                 'pywin.debugger.dbgcon', 'pywin.dialogs', 'tcl',
                 'Tkconstants', 'Tkinter']
-    packages = []
+    packages = ['numpy']
     dll_excludes = ['libgdk-win32-2.0-0.dll', 'libgobject-2.0-0.dll', 'MSVCP90.dll',
                     'tcl84.dll', 'tk84.dll']
     icon_resources = [(1, 'icon.ico')]
@@ -139,7 +139,7 @@ elif sys.platform == 'darwin':
     excludes = ['Tkconstants', 'Tkinter', '_gtkagg', '_tkagg', 'bsddb',
                 'curses', 'email', 'pywin.debugger', 'pywin.debugger.dbgcon',
                 'pywin.dialogs', 'tcl']
-    packages = []
+    packages = ['numpy']
     frameworks = []
     dylib_excludes = []
     datamodels = []
@@ -218,7 +218,7 @@ elif sys.platform == 'linux2':
     excludes = ['bsddb', 'curses', 'email', '_gtkagg', 'pywin.debugger',
                 'pywin.debugger.dbgcon', 'pywin.dialogs', 'tcl',
                 '_tkagg', 'Tkconstants', 'Tkinter']
-    packages = []
+    packages = ['numpy']
     path = []
     
     # This is a place where the user custom code may go. You can do almost